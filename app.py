@@ -1,24 +1,63 @@
-from dash import Dash, html, dcc, dash_table, Input, Output
-import pandas as pd
+from dash import Dash, html, dcc, dash_table, Input, Output, State, MATCH, ctx
+from dash.dash_table.Format import Format, Scheme, Symbol
+from flask import Response, abort, request, send_file
+from urllib.parse import urlencode
+import functools
+import os
+import time
 import backend  # Assuming backend.py is in the same directory
-import plotly.express as px
 
-# Initialize the Dash app
-app = Dash(__name__)
+# Initialize the Dash app. Tab contents are rendered on demand, so their components are not in the initial layout
+app = Dash(__name__, suppress_callback_exceptions=True)
 app.title = "Clinical Trial Data Dashboard"
+server = app.server  # WSGI entry point, e.g. gunicorn app:server
 
-# Load data using backend functions
-backend.initialize_database()
-backend.load_data(backend.csv_file)
-
-# Grab DataFrames
-frequency_df = backend.get_frequency()
-subset_df, statistics_df = backend.get_statistics()
-baseline_df = backend.get_specific_subset_data()
+# No data is loaded at import time: run `python backend.py load` once before starting the server
+# (`python app.py` does this for you). DataFrames are fetched from backend when a tab or callback
+# needs them. The on-disk cache tier shares results between worker processes and survives restarts,
+# and new data invalidates it, so a page reload picks up new data without a restart
+backend.configure_cache(disk_dir=os.environ.get('RESULT_CACHE_DIR', '.result_cache'))
 
 # Preparing table for part 2
-frequency_display = frequency_df[['sample', 'total_count', 'population', 'count', 'percentage']]
-frequency_display['percentage'] = frequency_display['percentage'].map("{:.2f}%".format)
+frequency_columns = [
+    {"name": 'sample', "id": 'sample'},
+    {"name": 'total_count', "id": 'total_count', "type": 'numeric'},
+    {"name": 'population', "id": 'population'},
+    {"name": 'count', "id": 'count', "type": 'numeric'},
+    {"name": 'percentage', "id": 'percentage', "type": 'numeric',
+     "format": Format(precision=2, scheme=Scheme.fixed).symbol(Symbol.yes).symbol_suffix('%')},
+]
+
+# Dash filter syntax operators, longest first so 'ge' is not read as 'gt' etc.
+filter_operators = [
+    ('ge', ['ge ', '>=']),
+    ('le', ['le ', '<=']),
+    ('lt', ['lt ', '<']),
+    ('gt', ['gt ', '>']),
+    ('ne', ['ne ', '!=']),
+    ('eq', ['eq ', '=']),
+    ('contains', ['contains ']),
+    ('datestartswith', ['datestartswith ']),
+]
+
+def split_filter_part(filter_part):
+    for name, tokens in filter_operators:
+        for token in tokens:
+            if token in filter_part:
+                column_part, value_part = filter_part.split(token, 1)
+                column = column_part[column_part.find('{') + 1: column_part.rfind('}')]
+                value_part = value_part.strip()
+
+                if value_part and value_part[0] == value_part[-1] and value_part[0] in ("'", '"', '`'):
+                    value = value_part[1:-1].replace('\\' + value_part[0], value_part[0])
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                return column, name, value
+    return None
 
 # Desired order for part 3
 desired_order = [
@@ -35,216 +74,537 @@ desired_order = [
     'test statistic'
 ]
 
-# Preparing metrics for part 4
-total_patients = len(baseline_df)
-males = len(baseline_df[baseline_df['sex'] == 'M'])
-females = len(baseline_df[baseline_df['sex'] == 'F'])
-responders = len(baseline_df[baseline_df['response'] == 'yes'])
-non_responders = len(baseline_df[baseline_df['response'] == 'no'])
-
-# Layout of the app
-app.layout = html.Div(style={'fontFamily': 'Arial, sans-serif', 'maxWidth': '1200px', 'margin': '0 auto', 'padding': '20px'}, children=[
-    html.H1("Clinical Trial Data Dashboard", style={'textAlign': 'center', 'color': "#3A75AF"}),
-
-    html.Hr(),
-
-    dcc.Tabs([
-        # Tab for part 2: frequency
-        dcc.Tab(label='Cell Population Frequencies', children=[
-            html.H3("Relative Frequencies of Cell Populations"),
-            html.P("This table shows the relative frequencies of different cell populations across samples."),
-        
+# Columns of the baseline table for part 4
+baseline_columns = ['project', 'response', 'sex', 'sample']
+
+# Background jobs: a panel shows the progress of the job whose id is in its store and links to the
+# result when it is done. The store lives in the browser session, so a reload resumes polling
+job_columns = ['population', 'p-value', 'adjusted p-value', 'permutation p-value', 'adjusted permutation p-value',
+               'significant', 'effect size', 'effect size CI low', 'effect size CI high', 'n responders', 'n non-responders']
+
+def job_panel(panel, download_label):
+    return [
+        dcc.Store(id={'type': 'job-id', 'panel': panel}, storage_type='session'),
+        dcc.Interval(id={'type': 'job-poll', 'panel': panel}, interval=1000, disabled=True),
+        html.Div(id={'type': 'job-status', 'panel': panel}, style={'marginTop': '10px'}),
+        html.A(download_label, id={'type': 'job-download', 'panel': panel}, style={'display': 'none'})
+    ]
+
+# Tab for part 2: frequency
+@backend.instrumented
+def frequency_tab():
+    return [
+        html.H3("Relative Frequencies of Cell Populations"),
+        html.P("This table shows the relative frequencies of different cell populations across samples."),
+
+        # Paging, sorting and filtering happen in the database; only the visible page is sent
+        dash_table.DataTable(
+            id='frequency-table',
+            columns=frequency_columns,
+            page_current=0,
+            page_size=20,
+            page_action='custom',
+            sort_action='custom',
+            sort_mode='multi',
+            sort_by=[],
+            filter_action='custom',
+            filter_query='',
+            style_table={'overflowX': 'auto'},
+            style_cell={'textAlign': 'left', 'padding': '5px'},
+            style_header={'backgroundColor': '#3A75AF', 'color': 'white', 'fontWeight': 'bold'}
+        ),
+        # The export is written by a background job and downloaded once it is ready
+        html.Button("Prepare CSV export", id='frequency-export', style={'marginTop': '10px'}),
+        *job_panel('frequency', "Download CSV")
+    ]
+
+
+# Tab for part 3: statistics
+@backend.instrumented
+def statistics_tab():
+    subset_df, statistics_df = backend.get_statistics()
+    with backend.span('serialize'):
+        statistics_records = statistics_df.to_dict('records')
+
+    return [
+        html.Div(style={'padding': '10px'}, children=[
+            html.Div([
+                html.H3("Responder vs. Non-Responder Statistical Analysis"),
+                html.Label("Select Cell Population to View Statistics:"),
+                dcc.Dropdown(
+                    id='population-dropdown',
+                    persistence=True,
+                    options=[{'label': 'All Populations', 'value': 'all'}] + 
+                            [{'label': i, 'value': i} for i in sorted(subset_df['population'].unique())],
+                    value='all',  # Default value in dropdown
+                    clearable=False,
+                    style={'width': '300px'}
+                ),
+                dcc.Checklist(
+                    id='box-points',
+                    options=[{'label': f' Show a sample of up to {backend.BOX_MAX_POINTS} points per group', 'value': 'points'}],
+                    value=['points'],
+                    persistence=True,
+                    style={'marginTop': '10px'}
+                ),
+                dcc.Graph(id='box-plot')
+            ]),
+
+            html.Hr(),
+
+            html.H3("Statistical Summary Table"),
+            html.P("Comparision using Welch's t-test or Mann-Whitney U test based on normality."),
+
             dash_table.DataTable(
-                data=frequency_display.to_dict('records'),
-                columns=[{"name": i, "id": i} for i in frequency_display.columns],
-                page_size=20,
+                data=statistics_records,
+                columns=[{"name": i, "id": i} for i in desired_order if i in statistics_df.columns],
                 style_table={'overflowX': 'auto'},
                 style_cell={'textAlign': 'left', 'padding': '5px'},
                 style_header={'backgroundColor': '#3A75AF', 'color': 'white', 'fontWeight': 'bold'},
-                export_format='csv'
-            )
-        ]),
+                style_data_conditional=[
+                    {
+                        'if': {'filter_query': '{significant} eq 1'},
+                        'backgroundColor': '#d4edda',
+                        'color': '#155724'
+                    }
+                ]
+            ),
+
+            html.Div(style={'backgroundColor': '#f8d7da', 'color': '#721c24', 'padding': '10px', 'borderRadius': '5px', 'marginTop': '20px'}, children=[
+                html.H4("Statistical Interpretation:", style={'marginTop': '0'}),
+                dcc.Markdown('''
+                * **Overall Findings:** There are no statistically signficant differences in baseline PBMC cell frequencies between responders and non-responders in melanoma patients treated with Miraclib.
+                * **Specific Observations:** Although CD4 T-cells showed a potential trends with a raw p-value of 0.0134, it was not statistically significant after corrrecting for multiple testing (adjusted p-value of 0.067). The effect size of -0.0644 was negligible, indicating minimal practical difference between groups. Other cell populations did not show any statistically significant differences, with all adjusted p-values well above the 0.05 threshold and small effect sizes.
+                * **Methodoloy Note:** The Shapiro-Wilk test indicated that the data did not meet normality assumptions, leading to the use of the Mann-Whitney U test for non-parametric comparisons.
+                * **Conclusion:** These results suggest that baseline PBMC cell frequencies may not be reliable predictors of treatment response in this specific clinical context. Further research with larger sample sizes or additional biomarkers may be necessary to identify factors influencing treatment outcomes.
+                ''')
+            ]),
+
+            html.Hr(),
 
-        # Tab for part 3: statistics
-        dcc.Tab(label='Statistical Analysis', children=[
-            html.Div(style={'padding': '10px'}, children=[
+            # Heavier comparisons run as background jobs; identical requests share one job
+            html.H3("Batch Analysis"),
+            html.P("Compare responders and non-responders in every cohort of the whole trial. The analysis runs in the background and finished results are reused until new data is loaded."),
+            html.Div(style={'display': 'flex', 'gap': '30px', 'alignItems': 'flex-end', 'marginBottom': '10px'}, children=[
                 html.Div([
-                    html.H3("Responder vs. Non-Responder Statistical Analysis"),
-                    html.Label("Select Cell Population to View Statistics:"),
+                    html.Label("Cohorts by:", style={'fontWeight': 'bold'}),
                     dcc.Dropdown(
-                        id='population-dropdown',
-                        options=[{'label': 'All Populations', 'value': 'all'}] + 
-                                [{'label': i, 'value': i} for i in sorted(subset_df['population'].unique())],
-                        value='all',  # Default value in dropdown
+                        id='job-group-by',
+                        persistence=True,
+                        options=backend.COHORT_COLS,
+                        value=['condition', 'treatment', 'sample_type', 'time_from_treatment_start'],
+                        multi=True
+                    )
+                ], style={'width': '40%'}),
+                html.Div([
+                    html.Label("Correction:", style={'fontWeight': 'bold'}),
+                    dcc.RadioItems(
+                        id='job-correction',
+                        persistence=True,
+                        options=[{'label': ' Bonferroni', 'value': 'bonferroni'},
+                                 {'label': ' FDR (Benjamini-Hochberg)', 'value': 'fdr'}],
+                        value='bonferroni'
+                    )
+                ]),
+                html.Div([
+                    html.Label("Resamples:", style={'fontWeight': 'bold'}),
+                    dcc.Dropdown(
+                        id='job-resamples',
+                        persistence=True,
+                        options=[{'label': 'None', 'value': 0}, {'label': '1,000', 'value': 1000},
+                                 {'label': '10,000', 'value': 10000}],
+                        value=0,
                         clearable=False,
-                        style={'width': '300px'}
-                    ),
-                    dcc.Graph(id='box-plot')
+                        style={'width': '120px'}
+                    )
                 ]),
+                html.Button("Run in background", id='job-submit')
+            ]),
+            *job_panel('statistics', "Download results as CSV"),
+            dash_table.DataTable(
+                id='job-results',
+                page_size=20,
+                sort_action='native',
+                style_table={'overflowX': 'auto', 'marginTop': '10px'},
+                style_cell={'textAlign': 'left', 'padding': '5px'},
+                style_header={'backgroundColor': '#3A75AF', 'color': 'white', 'fontWeight': 'bold'}
+            )
+        ])
+    ]
 
-                html.Hr(),
-
-                html.H3("Statistical Summary Table"),
-                html.P("Comparision using Welch's t-test or Mann-Whitney U test based on normality."),
-
-                dash_table.DataTable(
-                    data=statistics_df.to_dict('records'),
-                    columns=[{"name": i, "id": i} for i in desired_order if i in statistics_df.columns],
-                    style_table={'overflowX': 'auto'},
-                    style_cell={'textAlign': 'left', 'padding': '5px'},
-                    style_header={'backgroundColor': '#3A75AF', 'color': 'white', 'fontWeight': 'bold'},
-                    style_data_conditional=[
-                        {
-                            'if': {'filter_query': '{significant} eq 1'},
-                            'backgroundColor': '#d4edda',
-                            'color': '#155724'
-                        }
-                    ]
-                ),
 
-                html.Div(style={'backgroundColor': '#f8d7da', 'color': '#721c24', 'padding': '10px', 'borderRadius': '5px', 'marginTop': '20px'}, children=[
-                    html.H4("Statistical Interpretation:", style={'marginTop': '0'}),
-                    dcc.Markdown('''
-                    * **Overall Findings:** There are no statistically signficant differences in baseline PBMC cell frequencies between responders and non-responders in melanoma patients treated with Miraclib.
-                    * **Specific Observations:** Although CD4 T-cells showed a potential trends with a raw p-value of 0.0134, it was not statistically significant after corrrecting for multiple testing (adjusted p-value of 0.067). The effect size of -0.0644 was negligible, indicating minimal practical difference between groups. Other cell populations did not show any statistically significant differences, with all adjusted p-values well above the 0.05 threshold and small effect sizes.
-                    * **Methodoloy Note:** The Shapiro-Wilk test indicated that the data did not meet normality assumptions, leading to the use of the Mann-Whitney U test for non-parametric comparisons.
-                    * **Conclusion:** These results suggest that baseline PBMC cell frequencies may not be reliable predictors of treatment response in this specific clinical context. Further research with larger sample sizes or additional biomarkers may be necessary to identify factors influencing treatment outcomes.
-                    ''')
-                ])
-            ])
-        ]),
-
-        # Tab for part 4: baseline characteristics
-        dcc.Tab(label='Baseline Characteristics', children=[
-            html.Div(style={'padding': '10px'}, children=[
-                html.H3("Baseline Demographics (Time = 0)"),
-                html.P("Filter to explore specific subgroups."),
-
-                html.Div(style={'display': 'flex', 'gap': '50px', 'marginBottom': '20px', 'padding': '10px'}, children=[
-                    html.Div([
-                        html.Label("Filter by Project:", style={'fontWeight': 'bold'}),
-                        dcc.Dropdown(
-                            id='project-filter',
-                            options=sorted(baseline_df['project'].unique()),
-                            multi=True,
-                            placeholder="All Projects"
-                        )
-                    ], style={'width': '30%', 'textAlign': 'center'}),
-
-                    html.Div([
-                        html.Label("Filter by Sex:", style={'fontWeight': 'bold'}),
-                        dcc.Dropdown(
-                            id='sex-filter',
-                            options=['M', 'F'],
-                            multi=True,
-                            placeholder="All Sexes"
-                        )
-                    ], style={'width': '30%', 'textAlign': 'center'}),
-
-                    html.Div([
-                        html.Label("Filter by Response:", style={'fontWeight': 'bold'}),
-                        dcc.Dropdown(
-                            id='response-filter',
-                            options=['yes', 'no'],
-                            multi=True,
-                            placeholder="All Responses"
-                        )
-                    ], style={'width': '30%', 'textAlign': 'center'})
-                ]),
+# Tab for part 4: baseline characteristics
+@backend.instrumented
+def baseline_tab():
+    baseline_projects = backend.get_cohort_counts(['project'], **backend.BASELINE_FILTERS)
+
+    return [
+        html.Div(style={'padding': '10px'}, children=[
+            html.H3("Baseline Demographics (Time = 0)"),
+            html.P("Filter to explore specific subgroups."),
 
-                html.Div(style={'display': 'flex', 'justifyContent': 'space-around', 'marginBottom': '20px'}, children=[
-                    html.Div(style={'border': '1px solid #ccc', 'borderRadius': '10px', 'padding': '10px', 'width': '25%', 'textAlign': 'center'}, children=[
-                        html.H2(id='metric-total', style={'margin': '0', 'color': '#3A75AF'}),
-                        html.P('Samples Selected')
-                    ]),
-                    html.Div(style={'border': '1px solid #ccc', 'borderRadius': '10px', 'padding': '10px', 'width': '25%', 'textAlign': 'center'}, children=[
-                        html.H2(id='metric-sex', style={'margin': '0', 'color': '#3A75AF'}),
-                        html.P('Gender Split')
-                    ]),
-                    html.Div(style={'border': '1px solid #ccc', 'borderRadius': '10px', 'padding': '10px', 'width': '25%', 'textAlign': 'center'}, children=[
-                        html.H2(id='metric-response', style={'margin': '0', 'color': '#3A75AF'}),
-                        html.P('Responders vs Non-Responders')
-                    ]),
+            html.Div(style={'display': 'flex', 'gap': '50px', 'marginBottom': '20px', 'padding': '10px'}, children=[
+                html.Div([
+                    html.Label("Filter by Project:", style={'fontWeight': 'bold'}),
+                    dcc.Dropdown(
+                        id='project-filter',
+                        persistence=True,
+                        options=sorted(baseline_projects.loc[baseline_projects['sample_count'] > 0, 'project']),
+                        multi=True,
+                        placeholder="All Projects"
+                    )
+                ], style={'width': '30%', 'textAlign': 'center'}),
+
+                html.Div([
+                    html.Label("Filter by Sex:", style={'fontWeight': 'bold'}),
+                    dcc.Dropdown(
+                        id='sex-filter',
+                        persistence=True,
+                        options=['M', 'F'],
+                        multi=True,
+                        placeholder="All Sexes"
+                    )
+                ], style={'width': '30%', 'textAlign': 'center'}),
+
+                html.Div([
+                    html.Label("Filter by Response:", style={'fontWeight': 'bold'}),
+                    dcc.Dropdown(
+                        id='response-filter',
+                        persistence=True,
+                        options=['yes', 'no'],
+                        multi=True,
+                        placeholder="All Responses"
+                    )
+                ], style={'width': '30%', 'textAlign': 'center'})
+            ]),
+
+            html.Div(style={'display': 'flex', 'justifyContent': 'space-around', 'marginBottom': '20px'}, children=[
+                html.Div(style={'border': '1px solid #ccc', 'borderRadius': '10px', 'padding': '10px', 'width': '25%', 'textAlign': 'center'}, children=[
+                    html.H2(id='metric-total', style={'margin': '0', 'color': '#3A75AF'}),
+                    html.P('Samples Selected')
+                ]),
+                html.Div(style={'border': '1px solid #ccc', 'borderRadius': '10px', 'padding': '10px', 'width': '25%', 'textAlign': 'center'}, children=[
+                    html.H2(id='metric-sex', style={'margin': '0', 'color': '#3A75AF'}),
+                    html.P('Gender Split')
                 ]),
+                html.Div(style={'border': '1px solid #ccc', 'borderRadius': '10px', 'padding': '10px', 'width': '25%', 'textAlign': 'center'}, children=[
+                    html.H2(id='metric-response', style={'margin': '0', 'color': '#3A75AF'}),
+                    html.P('Responders vs Non-Responders')
+                ]),
+            ]),
 
-                html.H4("Baseline Data Table"),
-                dash_table.DataTable(
-                    id='baseline-table',
-                    columns=[{"name": i, "id": i} for i in baseline_df.columns],
-                    page_size=20,
-                    style_cell={'textAlign': 'left', 'padding': '5px'},
-                    style_header={'backgroundColor': '#3A75AF', 'color': 'white', 'fontWeight': 'bold'},
-                    export_format='csv'
-                )
-            ])
-        ]),
+            html.H4("Baseline Data Table"),
+            dash_table.DataTable(
+                id='baseline-table',
+                columns=[{"name": i, "id": i} for i in baseline_columns],
+                page_current=0,
+                page_size=20,
+                page_action='custom',
+                style_cell={'textAlign': 'left', 'padding': '5px'},
+                style_header={'backgroundColor': '#3A75AF', 'color': 'white', 'fontWeight': 'bold'}
+            ),
+            html.A("Export CSV", id='baseline-export', href='/download/baseline.csv', download='baseline.csv',
+                   style={'display': 'inline-block', 'marginTop': '10px'})
+        ])
+    ]
+
+# Layout of the app, rebuilt on every page load. Only the selected tab is rendered, so each
+# tab's data is computed the first time it is opened rather than when the server starts
+tabs = {
+    'frequency': ('Cell Population Frequencies', frequency_tab),
+    'statistics': ('Statistical Analysis', statistics_tab),
+    'baseline': ('Baseline Characteristics', baseline_tab),
+}
+
+def serve_layout():
+    return html.Div(style={'fontFamily': 'Arial, sans-serif', 'maxWidth': '1200px', 'margin': '0 auto', 'padding': '20px'}, children=[
+        html.H1("Clinical Trial Data Dashboard", style={'textAlign': 'center', 'color': "#3A75AF"}),
+
+        html.Hr(),
+
+        dcc.Tabs(id='tabs', value='frequency', children=[dcc.Tab(label=label, value=value) for value, (label, _) in tabs.items()]),
+        html.Div(id='tab-content')
     ])
-])
+
+app.layout = serve_layout
+
 
 # Callbacks
 @app.callback(
-    Output('box-plot', 'figure'),
-    Input('population-dropdown', 'value')
+    Output('tab-content', 'children'),
+    Input('tabs', 'value')
+)
+@backend.instrumented
+def render_tab(tab):
+    return tabs[tab][1]()
+
+@app.callback(
+    [Output('frequency-table', 'data'),
+     Output('frequency-table', 'page_count')],
+    [Input('frequency-table', 'page_current'),
+     Input('frequency-table', 'page_size'),
+     Input('frequency-table', 'sort_by'),
+     Input('frequency-table', 'filter_query')]
 )
-def update_box_plot(selected_population):
-    if selected_population == 'all':
-        fig = px.box(
-            subset_df,
-            x='response',
-            y='percentage',
-            color='response',
-            points='all',
-            facet_col='population',
-            facet_col_wrap=5,
-            title='Percentage Distribution of Cell Populations by Response',
-            color_discrete_map={'yes': "green", 'no': "red"}
-        )
-        fig.update_yaxes(matches='y') 
-        fig.for_each_annotation(lambda a: a.update(text=a.text.split("=")[-1].replace("_", " ").title()))
+@backend.instrumented
+def update_frequency_table(page_current, page_size, sort_by, filter_query):
+    conditions = []
+    for filter_part in (filter_query or '').split(' && '):
+        parsed = split_filter_part(filter_part)
+        if parsed is not None:
+            conditions.append(parsed)
+
+    page, total_rows = backend.get_frequency_page(
+        page_current or 0,
+        page_size,
+        sort_by=[(s['column_id'], s['direction']) for s in sort_by or []],
+        conditions=conditions
+    )
+    page_count = max(-(-total_rows // page_size), 1)
+    with backend.span('serialize'):
+        return page.to_dict('records'), page_count
+
+# The full table is streamed to the browser in chunks instead of being exported from the client
+@app.server.route('/download/frequency.csv')
+def download_frequency_csv():
+    return Response(
+        backend.iter_frequency_csv(),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=frequency.csv'}
+    )
+
+# Boxes are drawn from server-side quartiles and whiskers; only outliers and a capped sample of
+# points are sent. Figures are memoized per population and data version
+response_colors = {'yes': "green", 'no': "red"}
+
+@functools.lru_cache(maxsize=32)
+@backend.instrumented
+def build_box_figure(selected_population, show_points, data_version):
+    from plotly.subplots import make_subplots  # deferred: plotly is slow to import and only this tab needs it
+    import plotly.graph_objects as go
+
+    summary = backend.get_box_summary()
+    populations = sorted(summary['population'].unique()) if selected_population == 'all' else [selected_population]
+
+    fig = make_subplots(
+        rows=1, cols=len(populations), shared_yaxes=True,
+        subplot_titles=[p.replace("_", " ").title() for p in populations] if len(populations) > 1 else None
+    )
+    for col, population in enumerate(populations, start=1):
+        for row in summary[summary['population'] == population].itertuples():
+            color = response_colors.get(row.response)
+            legend = dict(name=row.response, legendgroup=row.response, showlegend=col == 1)
+            fig.add_trace(go.Box(
+                x=[row.response], q1=[row.q1], median=[row.median], q3=[row.q3],
+                lowerfence=[row.lowerfence], upperfence=[row.upperfence], mean=[row.mean],
+                boxpoints=False, marker_color=color, **legend
+            ), row=1, col=col)
+            fig.add_trace(go.Scatter(
+                x=[row.response] * len(row.outliers), y=row.outliers, mode='markers',
+                marker={'color': color, 'symbol': 'circle-open'}, name=row.response, legendgroup=row.response,
+                showlegend=False, hovertemplate='outlier: %{y:.2f}<extra></extra>'
+            ), row=1, col=col)
+            if show_points:
+                # An invisible box only used to draw the jittered sample next to the summary box
+                fig.add_trace(go.Box(
+                    x=[row.response] * len(row.points), y=row.points, boxpoints='all', jitter=0.4, pointpos=0,
+                    fillcolor='rgba(0,0,0,0)', line={'color': 'rgba(0,0,0,0)'}, marker={'color': color, 'size': 3, 'opacity': 0.4},
+                    hoveron='points', name=row.response, legendgroup=row.response, showlegend=False
+                ), row=1, col=col)
+
+    if len(populations) > 1:
+        title = 'Percentage Distribution of Cell Populations by Response'
     else:
-        filtered_data = subset_df[subset_df['population'] == selected_population]
-
-        fig = px.box(
-            filtered_data,
-            x='response',
-            y='percentage',
-            color='response',
-            points='all',
-            title=f'Percentage Distribution of {selected_population} by Response',
-            color_discrete_map={'yes': "green", 'no': "red"}
-        )
+        title = f'Percentage Distribution of {selected_population} by Response'
+    fig.update_layout(title=title, boxmode='overlay', legend_title_text='response')
+    fig.update_yaxes(title_text='percentage', col=1)
     return fig
 
+@app.callback(
+    Output('box-plot', 'figure'),
+    [Input('population-dropdown', 'value'),
+     Input('box-points', 'value')]
+)
+@backend.instrumented
+def update_box_plot(selected_population, box_points):
+    return build_box_figure(selected_population, 'points' in (box_points or []), backend.get_data_version())
+
+# Metric cards are answered from the cohort summary; only the visible page of rows is fetched
 @app.callback(
     [Output('baseline-table', 'data'),
+     Output('baseline-table', 'page_count'),
+     Output('baseline-table', 'page_current'),
+     Output('baseline-export', 'href'),
      Output('metric-total', 'children'),
      Output('metric-sex', 'children'),
      Output('metric-response', 'children')],
     [Input('project-filter', 'value'),
      Input('sex-filter', 'value'),
-     Input('response-filter', 'value')]
+     Input('response-filter', 'value'),
+     Input('baseline-table', 'page_current'),
+     Input('baseline-table', 'page_size')]
 )
-def update_baseline_table(selected_projects, selected_sexes, selected_responses):
-    full_dataset = baseline_df.copy()
-
-    if selected_projects:
-        full_dataset = full_dataset[full_dataset['project'].isin(selected_projects)]
-    if selected_sexes:
-        full_dataset = full_dataset[full_dataset['sex'].isin(selected_sexes)]
-    if selected_responses:
-        full_dataset = full_dataset[full_dataset['response'].isin(selected_responses)]
-
-    total_samples = len(full_dataset)
-    males = len(full_dataset[full_dataset['sex'] == 'M'])
-    females = len(full_dataset[full_dataset['sex'] == 'F'])
-    responders = len(full_dataset[full_dataset['response'] == 'yes'])
-    non_responders = len(full_dataset[full_dataset['response'] == 'no'])
+@backend.instrumented
+def update_baseline_table(selected_projects, selected_sexes, selected_responses, page_current, page_size):
+    filters = {
+        'project': selected_projects or None,
+        'sex': selected_sexes or None,
+        'response': selected_responses or None,
+    }
+
+    # Changing a filter starts again from the first page
+    if ctx.triggered_id != 'baseline-table':
+        page_current = 0
+
+    counts = backend.get_cohort_counts(['sex', 'response'], **{**backend.BASELINE_FILTERS, **filters})
+    total_samples = int(counts['sample_count'].sum())
+    males = int(counts.loc[counts['sex'] == 'M', 'sample_count'].sum())
+    females = int(counts.loc[counts['sex'] == 'F', 'sample_count'].sum())
+    responders = int(counts.loc[counts['response'] == 'yes', 'sample_count'].sum())
+    non_responders = int(counts.loc[counts['response'] == 'no', 'sample_count'].sum())
 
     gender_split = f"{males}M / {females}F"
     response_split = f"{responders} Responders / {non_responders} Non-Responders"
 
-    return full_dataset.to_dict('records'), total_samples, gender_split, response_split
+    page, _ = backend.get_specific_subset_page(page_current or 0, page_size, **filters)
+    page_count = max(-(-total_samples // page_size), 1)
+    export_href = '/download/baseline.csv?' + urlencode([(k, v) for k, values in filters.items() for v in values or []])
+
+    with backend.span('serialize'):
+        records = page.to_dict('records')
+    return records, page_count, page_current, export_href, total_samples, gender_split, response_split
+
+# Streams the filtered baseline cohort as CSV
+@app.server.route('/download/baseline.csv')
+def download_baseline_csv():
+    filters = {key: request.args.getlist(key) or None for key in ['project', 'sex', 'response']}
+    baseline = backend.get_specific_subset_data(**filters)
+    with backend.span('serialize', 'download_baseline_csv'):
+        body = baseline.to_csv(index=False)
+    return Response(
+        body,
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=baseline.csv'}
+    )
+
+# Submitting returns at once with the job's id; the panel then polls the job table
+@app.callback(
+    Output({'type': 'job-id', 'panel': 'statistics'}, 'data'),
+    Input('job-submit', 'n_clicks'),
+    [State('job-group-by', 'value'),
+     State('job-correction', 'value'),
+     State('job-resamples', 'value')],
+    prevent_initial_call=True
+)
+@backend.instrumented
+def submit_batch_statistics(n_clicks, group_by, correction, resamples):
+    return backend.submit_job('batch_statistics', group_by=group_by or [], correction=correction, resamples=resamples)
+
+@app.callback(
+    Output({'type': 'job-id', 'panel': 'frequency'}, 'data'),
+    Input('frequency-export', 'n_clicks'),
+    prevent_initial_call=True
+)
+@backend.instrumented
+def submit_frequency_export(n_clicks):
+    return backend.submit_job('frequency_csv')
+
+@app.callback(
+    [Output({'type': 'job-status', 'panel': MATCH}, 'children'),
+     Output({'type': 'job-poll', 'panel': MATCH}, 'disabled'),
+     Output({'type': 'job-download', 'panel': MATCH}, 'href'),
+     Output({'type': 'job-download', 'panel': MATCH}, 'style')],
+    [Input({'type': 'job-id', 'panel': MATCH}, 'data'),
+     Input({'type': 'job-poll', 'panel': MATCH}, 'n_intervals')]
+)
+@backend.instrumented
+def update_job_status(job_id, n_intervals):
+    hidden = {'display': 'none'}
+    job = backend.get_job(job_id) if job_id else None
+    if job is None:
+        return None, True, None, hidden
+    if job['status'] == 'done':
+        return "Done.", True, f"/jobs/{job_id}/download", {'display': 'inline-block'}
+    if job['status'] == 'failed':
+        return f"Failed: {job['error']}", True, None, hidden
+
+    label = "Queued" if job['status'] == 'queued' else f"Running: {job['message'] or 'started'}"
+    return [html.Progress(value=str(job['progress']), max='1', style={'width': '300px'}), html.Span(f" {label}")], False, None, hidden
+
+# The results table is filled when polling stops, or at once when the job had already finished
+@app.callback(
+    [Output('job-results', 'data'),
+     Output('job-results', 'columns')],
+    [Input({'type': 'job-id', 'panel': 'statistics'}, 'data'),
+     Input({'type': 'job-poll', 'panel': 'statistics'}, 'disabled')]
+)
+@backend.instrumented
+def update_job_results(job_id, polling_stopped):
+    results = backend.job_result(job_id) if job_id else None
+    if results is None:
+        return [], []
+    # The cohort columns, then the main results; the CSV download has every column
+    cohort_columns = list(results.columns[:results.columns.get_loc('population')])
+    columns = cohort_columns + [c for c in job_columns if c in results.columns]
+    with backend.span('serialize'):
+        return results[columns].to_dict('records'), [{"name": c, "id": c} for c in columns]
+
+# Job results are served from disk: exports as written, statistics frames as CSV
+@app.server.route('/jobs/<job_id>/download')
+def download_job_result(job_id):
+    job = backend.get_job(job_id)
+    if job is None or job['status'] != 'done':
+        abort(404)
+    filename = f"{job['kind']}.csv"
+    result = backend.job_result(job_id)
+    if isinstance(result, str):
+        return send_file(result, mimetype='text/csv', as_attachment=True, download_name=filename)
+    return Response(
+        result.to_csv(index=False),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+# Every request is timed until its response has been sent, so this includes Dash serializing the
+# callback outputs and streaming downloads. Dash updates are labelled with the outputs they return
+@server.before_request
+def start_request_timer():
+    if backend.metrics.enabled:
+        request.environ['metrics.start'] = time.perf_counter()
+
+@server.after_request
+def record_request_time(response):
+    start = request.environ.get('metrics.start')
+    if start is not None and request.path != '/metrics':
+        # Routes are labelled by their pattern (e.g. /jobs/<job_id>/download) and unmatched paths share
+        # one label, so probes and ids cannot grow the number of series
+        name = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        if request.path.endswith('/_dash-update-component'):
+            # The output comes from the request body, so only registered callbacks get their own label
+            output = (request.get_json(silent=True) or {}).get('output')
+            if output in app.callback_map:
+                name = output
+        response.call_on_close(lambda: backend.metrics.observe(name, 'request', time.perf_counter() - start))
+    return response
+
+# Prometheus scrape target. Each worker process keeps its own counters
+@server.route('/metrics')
+def metrics():
+    return Response(backend.metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Opt-in sampling profiler: with PROFILER=1, /profile?seconds=N samples every thread for N seconds and
+# returns collapsed stacks for a flame graph. Nothing is sampled unless a profile is requested
+@server.route('/profile')
+def sampling_profile():
+    if os.environ.get('PROFILER') != '1':
+        return Response("Profiler disabled; start the server with PROFILER=1", status=404, mimetype='text/plain')
+    seconds = min(request.args.get('seconds', 10, type=float), 60)
+    interval = request.args.get('interval', 0.005, type=float)
+    return Response(backend.profile(seconds, interval).collapsed(), mimetype='text/plain')
 
 # Run server
 if __name__ == '__main__':
+    # One-time data load for local runs; skipped when the CSV has not changed since the last load
+    backend.initialize_database()
+    backend.load_data(backend.csv_file)
     app.run(debug=True)
\ No newline at end of file
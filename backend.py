@@ -2,32 +2,688 @@ import sqlite3
 import pandas as pd
 import numpy as np
 import os
-import scipy.stats as stats
+import sys
+import hashlib
+import shutil
+import functools
+import bisect
+import tracemalloc
+import contextlib
+import json
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 
-DB_name = 'clinical_trial.db'
+# Both can be overridden from the environment, e.g. to point several workers at a shared database
+DB_name = os.environ.get('CLINICAL_TRIAL_DB', 'clinical_trial.db')
 csv_file = 'cell-count.csv'
 
+# CSV columns per table; in the database subjects and samples are keyed by integer subject_id / sample_id
+SUBJECT_COLS = ['subject', 'project', 'condition', 'age', 'sex', 'treatment', 'response', 'sample_type']
+SAMPLE_COLS = ['sample', 'subject', 'time_from_treatment_start', 'b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
+
+# Rows per chunk when streaming the CSV into the database
+CHUNK_SIZE = 100_000
+
+# Explicit dtypes avoid type inference per chunk; low-cardinality metadata is read as categoricals.
+# Numbers are nullable, so an empty cell is stored as NULL instead of failing the load
+CSV_DTYPES = {
+    'project': 'category',
+    'subject': 'string',
+    'condition': 'category',
+    'age': 'Int32',
+    'sex': 'category',
+    'treatment': 'category',
+    'response': 'category',
+    'sample': 'string',
+    'sample_type': 'category',
+    'time_from_treatment_start': 'Int32',
+    'b_cell': 'Int32',
+    'cd8_t_cell': 'Int32',
+    'cd4_t_cell': 'Int32',
+    'nk_cell': 'Int32',
+    'monocyte': 'Int32',
+}
+
+# Per-connection tuning; journal_mode=WAL is persistent and set once in initialize_database()
+CONNECTION_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative values are in KiB
+    'temp_store': 'MEMORY',
+}
+
+# Indexes for the join and filter paths used by the query functions
+# (subject_id is the rowid, which every index on subjects already carries)
+INDEXES = {
+    'idx_samples_subject_time': 'samples(subject_id, time_from_treatment_start)',
+    'idx_subjects_cohort': 'subjects(condition, treatment, sample_type)',
+    'idx_subjects_demographics': 'subjects(condition, sex, response)',
+}
+
+# Metadata is normalized once at ingest, so queries compare exact values instead of lower-casing on every call
+METADATA_NORMALIZERS = {
+    'project': lambda v: v.strip(),
+    'condition': lambda v: v.strip().lower(),
+    'treatment': lambda v: v.strip().lower(),
+    'response': lambda v: v.strip().lower(),
+    'sex': lambda v: v.strip().upper(),
+    'sample_type': lambda v: v.strip().upper(),
+}
+
+def normalize_value(column, value):
+    normalize = METADATA_NORMALIZERS.get(column)
+    return normalize(value) if normalize is not None and isinstance(value, str) else value
+
+def _normalize_metadata(chunk):
+    # Categoricals only need their few distinct values normalized, not every row
+    for column in METADATA_NORMALIZERS:
+        categories = [normalize_value(column, c) for c in chunk[column].cat.categories]
+        lookup = np.array(categories + [None], dtype=object)  # code -1 (missing) picks the trailing None
+        chunk[column] = pd.Categorical(lookup[chunk[column].cat.codes.to_numpy()])
+    return chunk
+
+def connect(read_only=False, **kwargs):
+    # Writers from several workers wait on each other instead of failing with "database is locked"
+    if read_only:
+        con = sqlite3.connect(f"file:{os.path.abspath(DB_name)}?mode=ro", uri=True, timeout=60, **kwargs)
+    else:
+        con = sqlite3.connect(DB_name, timeout=60, **kwargs)
+    for pragma, value in CONNECTION_PRAGMAS.items():
+        con.execute(f"PRAGMA {pragma} = {value}")
+    return con
+
+# Connection manager: query functions borrow an open read-only connection from a pool instead of
+# connecting on every call, and every write goes through one writer connection per process.
+# Readers and the writer all mmap the same file, so pages read by one are warm for the others.
+READ_POOL_SIZE = 16
+
+def _database_key():
+    # Pools are rebuilt after a fork, when DB_name changes, or when the file is replaced (e.g. deleted and reloaded)
+    path = os.path.abspath(DB_name)
+    try:
+        inode = os.stat(path).st_ino
+    except FileNotFoundError:
+        inode = None
+    return os.getpid(), path, inode
+
+class ReadPool:
+    def __init__(self, key, size=READ_POOL_SIZE):
+        self.key = key
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        # A connection is only ever used by the thread that borrowed it, so it may move between threads
+        return connect(read_only=True, check_same_thread=False)
+
+    def release(self, con):
+        # End any read transaction left open so the connection sees the latest commit next time
+        if con.in_transaction:
+            con.rollback()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(con)
+                return
+        con.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for con in idle:
+            con.close()
+
+_read_pool = None
+_writer = None
+_pool_lock = threading.Lock()
+_writer_lock = threading.RLock()
+
+@contextlib.contextmanager
+def read_connection():
+    global _read_pool
+    key = _database_key()
+    pool = _read_pool
+    if pool is None or pool.key != key:
+        with _pool_lock:
+            if _read_pool is None or _read_pool.key != key:
+                # Connections inherited across a fork are never touched, only dropped
+                if _read_pool is not None and _read_pool.key[0] == key[0]:
+                    _read_pool.close()
+                _read_pool = ReadPool(key)
+            pool = _read_pool
+
+    con = pool.acquire()
+    try:
+        yield con
+    finally:
+        pool.release(con)
+
+@contextlib.contextmanager
+def write_connection():
+    # One writer per process; threads queue on the lock and other processes on SQLite's file lock
+    global _writer
+    with _writer_lock:
+        key = _database_key()
+        if _writer is None or _writer[0] != key:
+            if _writer is not None and _writer[0][0] == key[0]:
+                _writer[1].close()
+            # Autocommit mode, so transactions are opened explicitly with BEGIN IMMEDIATE
+            con = connect(isolation_level=None, check_same_thread=False)
+            con.execute("PRAGMA foreign_keys = ON")
+            _writer = (_database_key(), con)
+
+        con = _writer[1]
+        try:
+            yield con
+        except BaseException:
+            # The writer outlives this call, so a failed transaction must not be left open
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+
+# Instrumentation: wall time (and optionally peak traced memory) of every instrumented function and of
+# the stages inside it (query, transform, stats, serialize, ...), rendered in the Prometheus text format.
+# METRICS=0 turns it off, leaving one flag check per call; METRICS_MEMORY=1 adds tracemalloc, which is not free
+METRICS_ENABLED = os.environ.get('METRICS', '1') != '0'
+METRICS_TRACK_MEMORY = os.environ.get('METRICS_MEMORY', '0') == '1'
+SPAN_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float('inf'))
+
+class Metrics:
+    def __init__(self, enabled=METRICS_ENABLED, track_memory=METRICS_TRACK_MEMORY):
+        self.enabled = enabled
+        self.track_memory = enabled and track_memory
+        self.spans = {}
+        self.lock = threading.Lock()
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def observe(self, name, stage, seconds, peak_bytes=None):
+        with self.lock:
+            entry = self.spans.get((name, stage))
+            if entry is None:
+                entry = self.spans[name, stage] = {'buckets': [0] * len(SPAN_BUCKETS), 'sum': 0.0, 'count': 0, 'peak_bytes': 0}
+            entry['buckets'][bisect.bisect_left(SPAN_BUCKETS, seconds)] += 1
+            entry['sum'] += seconds
+            entry['count'] += 1
+            if peak_bytes is not None:
+                entry['peak_bytes'] = max(entry['peak_bytes'], peak_bytes)
+
+    def render(self):
+        with self.lock:
+            spans = {key: dict(entry, buckets=list(entry['buckets'])) for key, entry in sorted(self.spans.items())}
+
+        lines = [
+            "# HELP backend_span_seconds Wall time of instrumented functions (stage=\"total\") and of their stages",
+            "# TYPE backend_span_seconds histogram",
+        ]
+        for (name, stage), entry in spans.items():
+            labels = f'name="{_label(name)}",stage="{_label(stage)}"'
+            cumulative = 0
+            for bound, count in zip(SPAN_BUCKETS, entry['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'backend_span_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"backend_span_seconds_sum{{{labels}}} {entry['sum']!r}")
+            lines.append(f"backend_span_seconds_count{{{labels}}} {entry['count']}")
+
+        if self.track_memory:
+            lines += [
+                "# HELP backend_span_peak_memory_bytes Largest peak of traced memory above the span's starting point",
+                "# TYPE backend_span_peak_memory_bytes gauge",
+            ]
+            for (name, stage), entry in spans.items():
+                lines.append(f'backend_span_peak_memory_bytes{{name="{_label(name)}",stage="{_label(stage)}"}} {entry["peak_bytes"]}')
+
+        lines += [
+            "# TYPE backend_cache_hits_total counter",
+            f"backend_cache_hits_total {result_cache.hits}",
+            "# TYPE backend_cache_misses_total counter",
+            f"backend_cache_misses_total {result_cache.misses}",
+            "# TYPE backend_cache_bytes gauge",
+            f"backend_cache_bytes {result_cache.total_bytes}",
+        ]
+        if os.path.exists('/proc/self/statm'):
+            with open('/proc/self/statm') as f:
+                resident_pages = int(f.read().split()[1])
+            lines += [
+                "# TYPE process_resident_memory_bytes gauge",
+                f"process_resident_memory_bytes {resident_pages * os.sysconf('SC_PAGE_SIZE')}",
+            ]
+        return '\n'.join(lines) + '\n'
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics()
+
+def configure_metrics(enabled=True, track_memory=False):
+    global metrics
+    if not track_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    metrics = Metrics(enabled, track_memory)
+    return metrics
+
+# Open spans per thread, so a stage is attributed to the innermost instrumented function
+_span_local = threading.local()
+
+class _Span:
+    __slots__ = ('stage', 'name', 'start', 'memory_start', 'memory_peak')
+
+    def __init__(self, stage, name):
+        self.stage = stage
+        self.name = name
+        self.memory_start = None
+
+    def __enter__(self):
+        stack = getattr(_span_local, 'stack', None)
+        if stack is None:
+            stack = _span_local.stack = []
+        if self.name is None:
+            self.name = stack[-1].name if stack else 'unknown'
+
+        if metrics.track_memory and tracemalloc.is_tracing():
+            # tracemalloc has a single peak, so the parent keeps the peak seen so far before it is reset
+            current, peak = tracemalloc.get_traced_memory()
+            if stack and stack[-1].memory_start is not None:
+                stack[-1].memory_peak = max(stack[-1].memory_peak, peak)
+            tracemalloc.reset_peak()
+            self.memory_start = self.memory_peak = current
+
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stack = _span_local.stack
+        stack.pop()
+
+        peak_bytes = None
+        if self.memory_start is not None and tracemalloc.is_tracing():
+            peak = max(self.memory_peak, tracemalloc.get_traced_memory()[1])
+            if stack and stack[-1].memory_start is not None:
+                stack[-1].memory_peak = max(stack[-1].memory_peak, peak)
+            peak_bytes = peak - self.memory_start
+
+        metrics.observe(self.name, self.stage, seconds, peak_bytes)
+        return False
+
+_NULL_SPAN = contextlib.nullcontext()
+
+def span(stage, name=None):
+    if not metrics.enabled:
+        return _NULL_SPAN
+    return _Span(stage, name)
+
+def instrumented(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not metrics.enabled:
+            return func(*args, **kwargs)
+        with _Span('total', func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+class SamplingProfiler:
+    # Samples the stack of every other thread at a fixed interval. Nothing runs until start() is called;
+    # collapsed() returns one "frame;frame;frame count" line per stack, the input format of flame graph tools
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]))
+
+def profile(seconds, interval=0.005):
+    profiler = SamplingProfiler(interval).start()
+    try:
+        time.sleep(seconds)
+    finally:
+        profiler.stop()
+    return profiler
+
+# Result cache: query results are keyed on the function, its arguments and the database's data
+# version, which load_data() bumps, so new data is picked up without restarting the dashboard
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_DISK_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+def get_data_version():
+    # '<database id>.<user_version>'. user_version starts again at 0 in a recreated database, so the
+    # random id written by initialize_database() keeps its versions apart from those of the file it replaced
+    with read_connection() as con:
+        try:
+            db_id, version = con.execute(
+                "SELECT (SELECT value FROM meta WHERE key = 'db_id'), user_version FROM pragma_user_version"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            # Not initialized yet
+            db_id, version = None, con.execute("PRAGMA user_version").fetchone()[0]
+    return f"{db_id or 'none'}.{version}"
+
+def _freeze(value):
+    # Make list / dict / set arguments hashable so they can be part of a cache key
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, set):
+        return tuple(sorted(_freeze(v) for v in value))
+    return value
+
+def _result_size(result):
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(index=True, deep=True).sum())
+    if isinstance(result, tuple):
+        return sum(_result_size(r) for r in result)
+    return sys.getsizeof(result)
+
+def _shallow_copy(result):
+    # Callers may add columns to what they get back; copies keep the cached frames untouched
+    if isinstance(result, pd.DataFrame):
+        return result.copy(deep=False)
+    if isinstance(result, tuple):
+        return tuple(_shallow_copy(r) for r in result)
+    return result
+
+class ResultCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, disk_dir=None, disk_max_bytes=CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.data_version = None
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def _disk_path(self, key):
+        digest = hashlib.sha256(repr(key[1:]).encode()).hexdigest()
+        return os.path.join(self.disk_dir, f"{key[0]}-{digest}.pkl")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key][0]
+
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            try:
+                result = pd.read_pickle(path)
+                # Files are trimmed oldest first, so a hit marks the file as recently used
+                os.utime(path)
+            except FileNotFoundError:
+                # Not cached, or removed by another worker's pruning
+                pass
+            else:
+                self.put(key, result, write_disk=False)
+                with self.lock:
+                    self.hits += 1
+                return True, result
+
+        with self.lock:
+            self.misses += 1
+        return False, None
+
+    def put(self, key, result, write_disk=True):
+        size = _result_size(result)
+        with self.lock:
+            # Results larger than the whole budget are never kept in memory
+            if size <= self.max_bytes:
+                if key in self.entries:
+                    self.total_bytes -= self.entries.pop(key)[1]
+                self.entries[key] = (result, size)
+                self.total_bytes += size
+                while self.total_bytes > self.max_bytes:
+                    _, (_, evicted_size) = self.entries.popitem(last=False)
+                    self.total_bytes -= evicted_size
+
+        if write_disk and self.disk_dir is not None and size <= self.disk_max_bytes:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            # Write to a temporary name first so other workers never read a partial file
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            pd.to_pickle(result, tmp_path)
+            os.replace(tmp_path, path)
+            self.trim_disk()
+
+    def _disk_files(self):
+        files = []
+        if self.disk_dir is None or not os.path.isdir(self.disk_dir):
+            return files
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.pkl'):
+                path = os.path.join(self.disk_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name, path))
+        return files
+
+    def _remove(self, path):
+        # Other workers share the directory and may have removed the file already
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def trim_disk(self):
+        # Least recently used files go first once the directory is over its byte budget
+        files = self._disk_files()
+        total = sum(size for _, size, _, _ in files)
+        for _, size, _, path in sorted(files):
+            if total <= self.disk_max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def prune_disk(self, data_version):
+        # Files from older data versions can never be hit again
+        for _, _, name, path in self._disk_files():
+            if not name.startswith(f"{data_version}-"):
+                self._remove(path)
+
+    def check_version(self, data_version):
+        # Every process that reads the cache drops older versions when it first sees a new one,
+        # so the disk tier is cleaned even when the load ran in another process
+        if data_version == self.data_version:
+            return
+        with self.lock:
+            self.data_version = data_version
+            for key in [key for key in self.entries if key[0] != data_version]:
+                self.total_bytes -= self.entries.pop(key)[1]
+        self.prune_disk(data_version)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+result_cache = ResultCache()
+
+def configure_cache(max_bytes=CACHE_MAX_BYTES, disk_dir=None, disk_max_bytes=CACHE_DISK_MAX_BYTES):
+    # disk_dir enables the on-disk tier, which survives restarts and is shared between workers;
+    # disk_max_bytes bounds its size
+    global result_cache
+    result_cache = ResultCache(max_bytes, disk_dir, disk_max_bytes)
+    return result_cache
+
+def cached(func=None, disk=True):
+    # @cached(disk=False) keeps results in memory only, for small results with many distinct
+    # arguments (table pages) that are cheap to recompute
+    if func is None:
+        return functools.partial(cached, disk=disk)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        data_version = get_data_version()
+        result_cache.check_version(data_version)
+        key = (data_version, os.path.abspath(DB_name), storage_backend, func.__name__, _freeze(args), _freeze(kwargs))
+        found, result = result_cache.get(key)
+        if not found:
+            result = func(*args, **kwargs)
+            result_cache.put(key, result, write_disk=disk)
+        return _shallow_copy(result)
+    return wrapper
+
+# Sample counts per cohort, kept up to date by triggers so the dashboard's counts never scan samples
+SUMMARY_COLS = ['project', 'sex', 'response', 'condition', 'treatment', 'sample_type', 'time_from_treatment_start']
+SUMMARY_SUBJECT_COLS = SUMMARY_COLS[:-1]
+
+# Missing metadata (e.g. response for healthy subjects) is stored as '' because NULLs never
+# conflict in a primary key, which would split one cohort over many rows
+def _subject_values(ref):
+    return ', '.join(f"IFNULL({ref}.{c}, '')" for c in SUMMARY_SUBJECT_COLS)
+
+def _subject_match(ref):
+    return ' AND '.join(f"cohort_summary.{c} = IFNULL({ref}.{c}, '')" for c in SUMMARY_SUBJECT_COLS)
+
+def _summary_upsert(select, count):
+    return f'''
+        INSERT INTO cohort_summary ({', '.join(SUMMARY_COLS)}, sample_count)
+        {select}
+        ON CONFLICT({', '.join(SUMMARY_COLS)}) DO UPDATE SET sample_count = sample_count + {count}
+    '''
+
+def _sample_summary_insert(ref):
+    return _summary_upsert(f'''
+        SELECT {_subject_values('subjects')}, {ref}.time_from_treatment_start, 1
+        FROM subjects WHERE subjects.subject_id = {ref}.subject_id
+    ''', 1)
+
+def _sample_summary_delete(ref):
+    return f'''
+        UPDATE cohort_summary SET sample_count = sample_count - 1
+        WHERE time_from_treatment_start IS {ref}.time_from_treatment_start
+          AND EXISTS (SELECT 1 FROM subjects WHERE subjects.subject_id = {ref}.subject_id AND {_subject_match('subjects')})
+    '''
+
+SUMMARY_TRIGGERS = {
+    'samples_summary_insert': f'''
+        AFTER INSERT ON samples BEGIN
+            {_sample_summary_insert('NEW')};
+        END
+    ''',
+    'samples_summary_delete': f'''
+        AFTER DELETE ON samples BEGIN
+            {_sample_summary_delete('OLD')};
+        END
+    ''',
+    'samples_summary_update': f'''
+        AFTER UPDATE OF subject_id, time_from_treatment_start ON samples BEGIN
+            {_sample_summary_delete('OLD')};
+            {_sample_summary_insert('NEW')};
+        END
+    ''',
+    # A subject whose metadata changes moves all of its samples to another cohort
+    'subjects_summary_update': f'''
+        AFTER UPDATE OF {', '.join(SUMMARY_SUBJECT_COLS)} ON subjects BEGIN
+            UPDATE cohort_summary SET sample_count = cohort_summary.sample_count - moved.sample_count
+            FROM (
+                SELECT time_from_treatment_start, COUNT(*) AS sample_count
+                FROM samples WHERE subject_id = OLD.subject_id GROUP BY time_from_treatment_start
+            ) AS moved
+            WHERE {_subject_match('OLD')}
+              AND cohort_summary.time_from_treatment_start IS moved.time_from_treatment_start;
+            {_summary_upsert(f"""
+                SELECT {_subject_values('NEW')}, time_from_treatment_start, COUNT(*)
+                FROM samples WHERE subject_id = NEW.subject_id GROUP BY time_from_treatment_start
+            """, 'excluded.sample_count')};
+        END
+    ''',
+}
+
+def rebuild_cohort_summary(con):
+    con.execute("DELETE FROM cohort_summary")
+    con.execute(f'''
+        INSERT INTO cohort_summary ({', '.join(SUMMARY_COLS)}, sample_count)
+        SELECT {_subject_values('subjects')}, samples.time_from_treatment_start, COUNT(*)
+        FROM samples
+        JOIN subjects ON samples.subject_id = subjects.subject_id
+        WHERE true
+        GROUP BY {_subject_values('subjects')}, samples.time_from_treatment_start
+    ''')
+
 # Part 1
-def initialize_database():
-    with sqlite3.connect(DB_name) as con:
+@instrumented
+def initialize_database(reset=False):
+    with write_connection() as con:
         cursor = con.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
 
-        # Clean up existing tables if they exist to avoid conflicts
-        cursor.execute("DROP TABLE IF EXISTS projects")
-        cursor.execute("DROP TABLE IF EXISTS subjects")
-        cursor.execute("DROP TABLE IF EXISTS samples")
+        # Databases from before the integer keys are never dropped implicitly; rebuilding is an explicit step
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(samples)")]
+        if columns and 'sample_id' not in columns and not reset:
+            cursor.execute("ROLLBACK")
+            raise RuntimeError(f"Database '{DB_name}' uses the old text-key schema. "
+                               f"Rebuild it with `python backend.py load --reset` before starting.")
 
-        cursor.execute("PRAGMA foreign_keys = ON;")
+        # Only drop the tables when a full rebuild is explicitly requested
+        if reset:
+            cursor.execute("DROP TABLE IF EXISTS samples")
+            cursor.execute("DROP TABLE IF EXISTS subjects")
+            cursor.execute("DROP TABLE IF EXISTS projects")
+            cursor.execute("DROP TABLE IF EXISTS ingest_log")
+            cursor.execute("DROP TABLE IF EXISTS cohort_summary")
+            # The data is gone, so results cached for the current version must not be served again
+            version = cursor.execute("PRAGMA user_version").fetchone()[0] + 1
+            cursor.execute(f"PRAGMA user_version = {version}")
+
+        # A random id for this database file, part of the data version (see get_data_version())
+        cursor.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        cursor.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('db_id', ?)", (os.urandom(8).hex(),))
 
         cursor.execute('''
-            CREATE TABLE projects (
+            CREATE TABLE IF NOT EXISTS projects (
                 project TEXT PRIMARY KEY
             )
         ''')
 
         cursor.execute('''
-            CREATE TABLE subjects (
-                subject TEXT PRIMARY KEY,
+            CREATE TABLE IF NOT EXISTS subjects (
+                subject_id INTEGER PRIMARY KEY,
+                subject TEXT NOT NULL UNIQUE,
                 project TEXT,
                 condition TEXT,
                 age INTEGER,
@@ -40,204 +696,1482 @@ def initialize_database():
         ''')
 
         cursor.execute('''
-            CREATE TABLE samples (
-                sample TEXT PRIMARY KEY,
-                subject TEXT,
+            CREATE TABLE IF NOT EXISTS samples (
+                sample_id INTEGER PRIMARY KEY,
+                sample TEXT NOT NULL UNIQUE,
+                subject_id INTEGER,
                 time_from_treatment_start INTEGER,
                 b_cell INTEGER,
                 cd8_t_cell INTEGER,
                 cd4_t_cell INTEGER,
                 nk_cell INTEGER,
                 monocyte INTEGER,
-                FOREIGN KEY (subject) REFERENCES subjects(subject)
+                FOREIGN KEY (subject_id) REFERENCES subjects(subject_id)
+            )
+        ''')
+
+        # Remembers which source files have been loaded so restarts can skip the ingest. A file being
+        # loaded is claimed with status 'loading' and the loader's pid, so other workers do not load it too
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ingest_log (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                content_hash TEXT,
+                loaded_at REAL,
+                status TEXT NOT NULL DEFAULT 'loaded',
+                pid INTEGER
+            )
+        ''')
+        log_columns = [row[1] for row in cursor.execute("PRAGMA table_info(ingest_log)")]
+        if 'status' not in log_columns:
+            cursor.execute("ALTER TABLE ingest_log ADD COLUMN status TEXT NOT NULL DEFAULT 'loaded'")
+            cursor.execute("ALTER TABLE ingest_log ADD COLUMN pid INTEGER")
+
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS cohort_summary (
+                project TEXT,
+                sex TEXT,
+                response TEXT,
+                condition TEXT,
+                treatment TEXT,
+                sample_type TEXT,
+                time_from_treatment_start INTEGER,
+                sample_count INTEGER,
+                PRIMARY KEY ({', '.join(SUMMARY_COLS)})
             )
         ''')
+
+        for name, definition in INDEXES.items():
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+
+        for name, definition in SUMMARY_TRIGGERS.items():
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {definition}")
+
+        # Databases created before the summary existed are backfilled once
+        summary_empty = cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM cohort_summary)").fetchone()[0]
+        samples_empty = cursor.execute("SELECT NOT EXISTS (SELECT 1 FROM samples)").fetchone()[0]
+        if summary_empty and not samples_empty:
+            rebuild_cohort_summary(con)
+        cursor.execute("COMMIT")
+
+        # WAL lets the dashboard keep reading while a load is writing
+        cursor.execute("PRAGMA journal_mode = WAL")
     
     print(f"Database '{DB_name}' initialized.")
 
-def load_data(csv_file):
+def file_fingerprint(path, block_size=1 << 20):
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime, digest.hexdigest()
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _values(frame, columns):
+    # Rows for executemany, with missing values as None so they are stored as NULL
+    return zip(*(frame[c].astype(object).where(frame[c].notna(), None).tolist() for c in columns))
+
+def _upsert_rows(con, chunk, seen_projects, seen_subjects):
+    # Projects and subjects repeat across chunks, so only rows not seen earlier in this load are sent
+    projects = chunk['project'].drop_duplicates().tolist()
+    new_projects = [(p,) for p in projects if p not in seen_projects]
+    seen_projects.update(projects)
+
+    subjects = chunk[SUBJECT_COLS].drop_duplicates(subset=['subject'])
+    subjects = subjects[~subjects['subject'].isin(seen_subjects)]
+    seen_subjects.update(subjects['subject'].tolist())
+
+    samples = chunk[SAMPLE_COLS].drop_duplicates(subset=['sample'])
+
+    con.executemany("INSERT OR IGNORE INTO projects (project) VALUES (?)", new_projects)
+
+    # Only rows whose values actually changed are rewritten
+    subject_updates = ', '.join(f"{c} = excluded.{c}" for c in SUBJECT_COLS[1:])
+    subject_changed = ' OR '.join(f"{c} IS NOT excluded.{c}" for c in SUBJECT_COLS[1:])
+    con.executemany(f'''
+        INSERT INTO subjects ({', '.join(SUBJECT_COLS)}) VALUES ({', '.join('?' * len(SUBJECT_COLS))})
+        ON CONFLICT(subject) DO UPDATE SET {subject_updates} WHERE {subject_changed}
+    ''', _values(subjects, SUBJECT_COLS))
+
+    # Samples reference their subject by its integer key, looked up through the unique index on subjects.subject
+    measurements = [c for c in SAMPLE_COLS if c not in ('sample', 'subject')]
+    sample_updates = ', '.join(f"{c} = excluded.{c}" for c in ['subject_id'] + measurements)
+    sample_changed = ' OR '.join(f"{c} IS NOT excluded.{c}" for c in ['subject_id'] + measurements)
+    con.executemany(f'''
+        INSERT INTO samples (sample, subject_id, {', '.join(measurements)})
+        SELECT ?, subjects.subject_id, {', '.join('?' * len(measurements))} FROM subjects WHERE subjects.subject = ?
+        ON CONFLICT(sample) DO UPDATE SET {sample_updates} WHERE {sample_changed}
+    ''', _values(samples, ['sample'] + measurements + ['subject']))
+
+@instrumented
+def load_data(csv_file, incremental=True, chunksize=CHUNK_SIZE):
     if not os.path.exists(csv_file):
         print(f"CSV file '{csv_file}' not found.")
         return
 
-    try:
-        df = pd.read_csv(csv_file)
-    except Exception as e:
-        print(f"Error reading CSV file: {e}")
-        return
-    
-    with sqlite3.connect(DB_name) as con:
-        con.execute("PRAGMA foreign_keys = ON;")
+    path = os.path.abspath(csv_file)
+    stat = os.stat(csv_file)
+
+    with write_connection() as con:
+        # Cheap check first: same path, size and mtime means the file has already been loaded
+        if incremental:
+            logged = con.execute("SELECT size, mtime, status FROM ingest_log WHERE path = ?", (path,)).fetchone()
+            if logged == (stat.st_size, stat.st_mtime, 'loaded'):
+                print(f"'{csv_file}' unchanged since last load, skipping.")
+                return
 
-        projects_cols = df[['project']].drop_duplicates()
-        subjects_cols = df[['subject', 'project', 'condition', 'age', 'sex', 'treatment', 'response', 'sample_type']].drop_duplicates(subset=['subject'])
-        samples_cols = df[['sample', 'subject', 'time_from_treatment_start', 'b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']].drop_duplicates(subset=['sample'])
+        _, size, mtime, content_hash = file_fingerprint(csv_file)
+
+        try:
+            # Stream the file so peak memory depends on the chunk size, not the file size
+            reader = pd.read_csv(csv_file, dtype=CSV_DTYPES, chunksize=chunksize)
+        except Exception as e:
+            print(f"Error reading CSV file: {e}")
+            return
 
+        seen_projects, seen_subjects = set(), set()
         try:
-            projects_cols.to_sql('projects', con, if_exists='append', index=False)
-            subjects_cols.to_sql('subjects', con, if_exists='append', index=False)
-            samples_cols.to_sql('samples', con, if_exists='append', index=False)
+            # Read one chunk ahead so the last chunk is known and the file is marked loaded in its transaction
+            chunks = iter(reader)
+            chunk, i = next(chunks, None), 0
+            while chunk is not None:
+                next_chunk = next(chunks, None)
+
+                # Take the write lock per chunk so concurrent workers load one chunk at a time
+                con.execute("BEGIN IMMEDIATE")
+
+                if i == 0:
+                    # Another worker may have loaded this file while we waited for the lock, or may still be loading it
+                    logged = con.execute("SELECT content_hash, status, pid FROM ingest_log WHERE path = ?", (path,)).fetchone()
+                    if incremental and logged is not None and logged[0] == content_hash:
+                        if logged[1] == 'loaded':
+                            con.execute("UPDATE ingest_log SET size = ?, mtime = ? WHERE path = ?", (size, mtime, path))
+                            con.execute("COMMIT")
+                            print(f"'{csv_file}' content unchanged since last load, skipping.")
+                            return
+                        if logged[2] != os.getpid() and _process_alive(logged[2]):
+                            con.execute("COMMIT")
+                            print(f"'{csv_file}' is being loaded by process {logged[2]}, skipping.")
+                            return
+
+                    # Claim the file for the rest of the load; a claim left by a process that died is taken over
+                    con.execute('''
+                        INSERT INTO ingest_log (path, size, mtime, content_hash, status, pid) VALUES (?, ?, ?, ?, 'loading', ?)
+                        ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime,
+                            content_hash = excluded.content_hash, status = 'loading', pid = excluded.pid
+                    ''', (path, size, mtime, content_hash, os.getpid()))
+
+                changes = con.total_changes
+                _upsert_rows(con, _normalize_metadata(chunk), seen_projects, seen_subjects)
+
+                # A chunk that changed data bumps the data version in its own transaction, so cached results
+                # are invalidated by every commit, including those of a load that fails later on
+                if con.total_changes != changes:
+                    data_version = con.execute("PRAGMA user_version").fetchone()[0] + 1
+                    con.execute(f"PRAGMA user_version = {data_version}")
+                if next_chunk is None:
+                    con.execute("UPDATE ingest_log SET status = 'loaded', pid = NULL, loaded_at = ? WHERE path = ?",
+                                (time.time(), path))
+                con.execute("COMMIT")
+                chunk, i = next_chunk, i + 1
+
+            result_cache.prune_disk(get_data_version())
+
+            # Refresh planner statistics so the new rows are taken into account when choosing indexes
+            con.execute("ANALYZE")
             print("Data loaded successfully into the database.")
+
+            if storage_backend == 'parquet':
+                sync_parquet()
         except sqlite3.IntegrityError as ie:
+            _abort_load(con, path)
             print(f"Integrity error: {ie}")
         except Exception as e:
+            _abort_load(con, path)
             print(f"Error loading data into database: {e}")
 
+def _abort_load(con, path):
+    # Releases the claim, so the partly loaded file is loaded again next time
+    if con.in_transaction:
+        con.execute("ROLLBACK")
+    con.execute("DELETE FROM ingest_log WHERE path = ? AND status = 'loading' AND pid = ?", (path, os.getpid()))
+
 # Part 2
-def get_frequency():
-    with sqlite3.connect(DB_name) as con:
-        query = '''
-            SELECT 
-                samples.sample, samples.b_cell, samples.cd8_t_cell, samples.cd4_t_cell, samples.nk_cell, samples.monocyte,
-                subjects.subject, subjects.condition, subjects.treatment, subjects.response, subjects.sample_type
-            FROM samples
-            JOIN subjects ON samples.subject = subjects.subject
-        '''
-        df = pd.read_sql_query(query, con)
-
-        population_cols = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
-        df['total_count'] = df[population_cols].sum(axis=1)
-
-        metadata_cols = ['sample', 'subject', 'condition', 'treatment', 'response', 'sample_type']
-
-        df_long = df.melt(
-            id_vars = metadata_cols + ['total_count'],
-            value_vars = population_cols,
-            var_name = 'population',
-            value_name = 'count'
-        )
+POPULATIONS = ['b_cell', 'cd8_t_cell', 'cd4_t_cell', 'nk_cell', 'monocyte']
+METADATA_COLS = ['sample', 'subject', 'condition', 'treatment', 'response', 'sample_type']
+
+# Frames are returned compact: IDs and metadata as categoricals (integer codes into one copy of each
+# distinct value) and counts as 32-bit integers
+FRAME_DTYPES = {
+    **{col: 'category' for col in ['sample', 'subject', 'project', 'condition', 'treatment', 'response', 'sex',
+                                   'sample_type', 'population']},
+    **{col: 'int32' for col in POPULATIONS + ['total_count', 'count', 'time_from_treatment_start']},
+}
+
+def _compact(df):
+    # Numbers with missing values (NULL in the database) keep their float dtype
+    return df.astype({col: dtype for col, dtype in FRAME_DTYPES.items()
+                      if col in df.columns and (dtype == 'category' or df[col].notna().all())})
+
+# Filters accepted by the query functions and the column each one applies to
+FILTER_COLUMNS = {
+    'project': 'subjects.project',
+    'condition': 'subjects.condition',
+    'treatment': 'subjects.treatment',
+    'response': 'subjects.response',
+    'sex': 'subjects.sex',
+    'sample_type': 'subjects.sample_type',
+    'time_from_treatment_start': 'samples.time_from_treatment_start',
+}
 
-        df_long['percentage'] = ((df_long['count'] / df_long['total_count']) * 100).round(2)
+FREQUENCY_QUERY = f'''
+    SELECT 
+        samples.sample, subjects.subject, subjects.condition, subjects.treatment, subjects.response, subjects.sample_type,
+        subjects.project, subjects.sex, samples.time_from_treatment_start,
+        {' + '.join(f'samples.{p}' for p in POPULATIONS)} AS total_count,
+        {', '.join(f'samples.{p}' for p in POPULATIONS)}
+    FROM samples
+    JOIN subjects ON samples.subject_id = subjects.subject_id
+'''
 
-        df_long = df_long.sort_values(by=['sample', 'population'])
+def build_filter_clause(filters, columns=FILTER_COLUMNS):
+    # Each filter takes a single value or a list of values; None means no filtering on that column
+    clauses, params = [], []
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if name not in columns:
+            raise ValueError(f"Unknown filter '{name}'. Expected one of {list(columns)}")
+        values = [normalize_value(name, v) for v in (value if isinstance(value, (list, tuple, set)) else [value])]
+        clauses.append(f"{columns[name]} IN ({', '.join('?' * len(values))})")
+        params.extend(values)
 
-        return df_long
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    return where, params
+
+@instrumented
+@cached
+def get_frequency_wide(**filters):
+    # One row per sample with a count and a percentage column per population
+    if storage_backend == 'parquet':
+        columns = METADATA_COLS + ['project', 'sex', 'time_from_treatment_start'] + POPULATIONS
+        with span('query'):
+            df = _read_parquet(columns, filters, sort_by='sample')
+        with span('transform'):
+            df.insert(len(columns) - len(POPULATIONS), 'total_count', df[POPULATIONS].sum(axis=1).astype('int32'))
+            return add_percentages(df)
+
+    where, params = build_filter_clause(filters)
+    with span('query'), read_connection() as con:
+        df = pd.read_sql_query(f"{FREQUENCY_QUERY} {where} ORDER BY samples.sample", con, params=params)
+
+    with span('transform'):
+        return add_percentages(_compact(df))
+
+def add_percentages(wide_df):
+    total = wide_df['total_count'].to_numpy()
+    for population in POPULATIONS:
+        wide_df[f'{population}_percentage'] = ((wide_df[population].to_numpy() / total) * 100).round(2)
+    return wide_df
+
+def _repeat(column, n):
+    # Categoricals are repeated through their codes, so no value is copied
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return pd.Categorical.from_codes(np.repeat(column.cat.codes.to_numpy(), n), dtype=column.dtype)
+    return np.repeat(column.to_numpy(), n)
+
+def to_long_format(wide_df):
+    # Melt without a sort: rows are already ordered by sample, so emitting populations
+    # in sorted order gives the (sample, population) ordering directly
+    populations = sorted(POPULATIONS)
+    n = len(populations)
+
+    long_df = pd.DataFrame({col: _repeat(wide_df[col], n) for col in METADATA_COLS + ['total_count']})
+    long_df['population'] = pd.Categorical.from_codes(np.tile(np.arange(n, dtype=np.int8), len(wide_df)), populations)
+    long_df['count'] = wide_df[populations].to_numpy().ravel()
+    long_df['percentage'] = wide_df[[f'{p}_percentage' for p in populations]].to_numpy().ravel()
+    return long_df
+
+@instrumented
+@cached
+def get_frequency(long=True, **filters):
+    df = get_frequency_wide(**filters)
+    with span('transform'):
+        return to_long_format(df) if long else df
+
+# Paged access to the long frequency table, so the dashboard only ever fetches the visible page
+FREQUENCY_TABLE_COLUMNS = ['sample', 'total_count', 'population', 'count', 'percentage']
+
+FILTER_OPERATORS = {
+    'eq': '=',
+    'ne': '!=',
+    'lt': '<',
+    'le': '<=',
+    'gt': '>',
+    'ge': '>=',
+    'contains': 'LIKE',
+    'datestartswith': 'LIKE',
+}
+
+FREQUENCY_LONG_CTE = 'WITH frequency_long AS (' + ' UNION ALL '.join(
+    f'''
+    SELECT sample, {' + '.join(POPULATIONS)} AS total_count, '{p}' AS population, {p} AS count,
+        ROUND({p} * 100.0 / ({' + '.join(POPULATIONS)}), 2) AS percentage
+    FROM samples'''
+    for p in POPULATIONS
+) + '\n)'
+
+def build_table_conditions(conditions):
+    # conditions is a list of (column, operator, value) with operators from FILTER_OPERATORS
+    clauses, params = [], []
+    for column, operator, value in conditions or []:
+        if column not in FREQUENCY_TABLE_COLUMNS:
+            raise ValueError(f"Unknown column '{column}'. Expected one of {FREQUENCY_TABLE_COLUMNS}")
+        if operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unsupported operator '{operator}'. Expected one of {list(FILTER_OPERATORS)}")
+
+        if operator == 'contains':
+            value = f'%{value}%'
+        elif operator == 'datestartswith':
+            value = f'{value}%'
+        clauses.append(f'"{column}" {FILTER_OPERATORS[operator]} ?')
+        params.append(value)
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    return where, params
+
+@instrumented
+@cached(disk=False)
+def get_frequency_page(page_current=0, page_size=20, sort_by=None, conditions=None):
+    # sort_by is a list of (column, 'asc' | 'desc'); returns the page and the total number of matching rows
+    offset = page_current * page_size
+    n_populations = len(POPULATIONS)
+
+    with read_connection() as con:
+        if not sort_by and not conditions:
+            # Default order is (sample, population), so the page maps onto a contiguous range of samples
+            total_rows = con.execute("SELECT COUNT(*) FROM samples").fetchone()[0] * n_populations
+            first_sample = offset // n_populations
+            last_sample = -(-(offset + page_size) // n_populations)
+            with span('query'):
+                wide_df = pd.read_sql_query(
+                    f"{FREQUENCY_QUERY} ORDER BY samples.sample LIMIT ? OFFSET ?",
+                    con, params=[last_sample - first_sample, first_sample]
+                )
+            start = offset - first_sample * n_populations
+            with span('transform'):
+                page = to_long_format(add_percentages(_compact(wide_df)))[FREQUENCY_TABLE_COLUMNS]
+            return page.iloc[start:start + page_size].reset_index(drop=True), total_rows
+
+        where, params = build_table_conditions(conditions)
+        order = []
+        for column, direction in sort_by or []:
+            if column not in FREQUENCY_TABLE_COLUMNS:
+                raise ValueError(f"Unknown column '{column}'. Expected one of {FREQUENCY_TABLE_COLUMNS}")
+            order.append(f'"{column}" {"DESC" if direction == "desc" else "ASC"}')
+        # Ties fall back to the default (sample, population) order so paging is stable
+        order_by = f"ORDER BY {', '.join(order + ['sample', 'population'])}"
+
+        with span('query'):
+            total_rows = con.execute(f"{FREQUENCY_LONG_CTE} SELECT COUNT(*) FROM frequency_long {where}", params).fetchone()[0]
+            page = pd.read_sql_query(
+                f"{FREQUENCY_LONG_CTE} SELECT {', '.join(FREQUENCY_TABLE_COLUMNS)} FROM frequency_long {where} {order_by} LIMIT ? OFFSET ?",
+                con, params=params + [page_size, offset]
+            )
+
+    # The percentage is rounded in SQL like in get_frequency_wide(), so filters and sorting see the value shown
+    return _compact(page), total_rows
+
+def iter_frequency_csv(chunksize=CHUNK_SIZE):
+    # Yields the long frequency table as CSV text, one chunk of samples at a time
+    with read_connection() as con:
+        header = True
+        for wide_df in pd.read_sql_query(f"{FREQUENCY_QUERY} ORDER BY samples.sample", con, chunksize=chunksize):
+            yield to_long_format(add_percentages(wide_df))[FREQUENCY_TABLE_COLUMNS].to_csv(index=False, header=header)
+            header = False
 
 # Part 3
-def get_statistics():
-    df = get_frequency()
+# Columns a batch of cohorts can be split by
+COHORT_COLS = ['project', 'condition', 'treatment', 'sample_type', 'sex', 'time_from_treatment_start']
+
+STATISTICS_COLS = [
+    'population', 'test used', 'test statistic', 'p-value', 'adjusted p-value', 'significant', 'effect size',
+    'responder mean', 'responder median', 'non-responder mean', 'non-responder median'
+]
+
+def _compare_cohort(responders, non_responders, resampling=None):
+    # responders / non_responders are (samples x populations) percentage arrays; every
+    # scipy call below runs once for all populations of the cohort along axis 0.
+    # resampling, if given, is the (resamples, bootstrap, confidence, early_stop, seed, key hash) of _resample_cohort
+    import scipy.stats as stats  # deferred so importing backend stays fast
+
+    n_populations = responders.shape[1]
+    num_responders, num_non_responders = len(responders), len(non_responders)
+
+    result = {
+        'test used': np.full(n_populations, "N/A", dtype=object),
+        'test statistic': np.full(n_populations, np.nan),
+        'p-value': np.full(n_populations, np.nan),
+        'effect size': np.full(n_populations, np.nan),
+    }
+
+    # Calculate means and medians
+    if num_responders > 0 and num_non_responders > 0:
+        result['responder mean'] = responders.mean(axis=0)
+        result['responder median'] = np.median(responders, axis=0)
+        result['non-responder mean'] = non_responders.mean(axis=0)
+        result['non-responder median'] = np.median(non_responders, axis=0)
+    else:
+        for key in ['responder mean', 'responder median', 'non-responder mean', 'non-responder median']:
+            result[key] = np.zeros(n_populations)
+
+    # Normality test using Shapiro-Wilk
+    is_normal = np.zeros(n_populations, dtype=bool)
+    if num_responders >= 3 and num_non_responders >= 3:
+        _, p_responders = stats.shapiro(responders, axis=0)
+        _, p_non_responders = stats.shapiro(non_responders, axis=0)
+        is_normal = (p_responders > 0.05) & (p_non_responders > 0.05)
+
+    if num_responders > 1 and num_non_responders > 1:
+        # Welch's t-test and Cohen's d where both groups look normal
+        if is_normal.any():
+            t_stat, t_p = stats.ttest_ind(responders[:, is_normal], non_responders[:, is_normal], axis=0, equal_var=False)
+            n1, n2 = num_responders, num_non_responders
+            var1 = np.var(responders[:, is_normal], axis=0, ddof=1)
+            var2 = np.var(non_responders[:, is_normal], axis=0, ddof=1)
+            std_pooled = np.sqrt(((n1 - 1) * var1 + (n2 - 1) * var2) / (n1 + n2 - 2))
+            mean_diff = result['responder mean'][is_normal] - result['non-responder mean'][is_normal]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cohens_d = np.where(std_pooled > 0, mean_diff / std_pooled, 0.0)
+
+            result['test used'][is_normal] = "Welch's t-test"
+            result['test statistic'][is_normal] = t_stat
+            result['p-value'][is_normal] = t_p
+            result['effect size'][is_normal] = cohens_d
+
+        # Mann-Whitney U and rank-biserial correlation otherwise
+        if (~is_normal).any():
+            u_stat, u_p = stats.mannwhitneyu(responders[:, ~is_normal], non_responders[:, ~is_normal], axis=0, alternative='two-sided')
+            result['test used'][~is_normal] = "Mann-Whitney U"
+            result['test statistic'][~is_normal] = u_stat
+            result['p-value'][~is_normal] = u_p
+            result['effect size'][~is_normal] = 1 - (2 * u_stat) / (num_responders * num_non_responders)
+
+    result['n responders'] = np.full(n_populations, num_responders)
+    result['n non-responders'] = np.full(n_populations, num_non_responders)
+
+    if resampling is not None:
+        tested = num_responders > 1 and num_non_responders > 1
+        result.update(_resample_cohort(responders, non_responders, is_normal, tested, *resampling))
+    return result
+
+# Resampling: permutation p-values and bootstrap confidence intervals, drawn in batches of
+# RESAMPLE_BATCH resamples and never more than RESAMPLE_BATCH_BYTES per batch matrix
+RESAMPLE_BATCH = 1000
+RESAMPLE_BATCH_BYTES = 32 * 1024 * 1024
+
+RESAMPLING_COLS = [
+    'permutation p-value', 'adjusted permutation p-value', 'permutations',
+    'mean difference', 'mean difference CI low', 'mean difference CI high',
+    'median difference', 'median difference CI low', 'median difference CI high',
+    'effect size CI low', 'effect size CI high'
+]
+
+def _batch_sizes(resamples, n):
+    size = max(1, min(RESAMPLE_BATCH, RESAMPLE_BATCH_BYTES // (8 * max(n, 1))))
+    for start in range(0, resamples, size):
+        yield min(size, resamples - start)
+
+def _welch_t(sum1, squares1, n1, total, total_squares, n):
+    # Welch's t from the responder group's sums; the non-responder sums are the remainder of the totals
+    n2 = n - n1
+    mean1, mean2 = sum1 / n1, (total - sum1) / n2
+    var1 = (squares1 - n1 * mean1 ** 2) / (n1 - 1)
+    var2 = (total_squares - squares1 - n2 * mean2 ** 2) / (n2 - 1)
+    return (mean1 - mean2) / np.sqrt(var1 / n1 + var2 / n2)
+
+def _permutation_test(responders, non_responders, is_normal, rng, resamples, early_stop):
+    # Shuffles the response labels and recomputes each population's own test statistic: Welch's t on the
+    # values, or the Mann-Whitney U on the pooled ranks. A shuffle is a 0/1 label row, so one batch of
+    # shuffles is a single (batch x samples) @ (samples x populations) product.
+    # Stops early once every population has seen early_stop statistics at least as extreme as its own
+    from scipy.stats import rankdata
+
+    n1, n = len(responders), len(responders) + len(non_responders)
+    pooled = np.concatenate([responders, non_responders])
+    pooled[:, ~is_normal] = rankdata(pooled[:, ~is_normal], axis=0)
+    squares = pooled ** 2
+    total, total_squares = pooled.sum(axis=0), squares.sum(axis=0)
 
-    subset = df[
-        (df['condition'].str.lower() == 'melanoma') &
-        (df['treatment'].str.lower() == 'miraclib') &
-        (df['sample_type'].str.upper() == 'PBMC')
-    ]
+    def extremeness(sum1, squares1):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.abs(_welch_t(sum1, squares1, n1, total, total_squares, n))
+        u = np.abs(sum1 - n1 * (n1 + 1) / 2 - n1 * (n - n1) / 2)
+        return np.where(is_normal, t, u)
 
-    statistical_results = []
-    populations = subset['population'].unique()
-    num_tests = len(populations)
+    observed = extremeness(pooled[:n1].sum(axis=0), squares[:n1].sum(axis=0))
+    # Permuted statistics that equal the observed one up to rounding error count as extreme
+    threshold = observed - 1e-9 * np.abs(observed)
 
-    for population in populations:
-        population_data = subset[subset['population'] == population]
+    labels = np.zeros(n)
+    labels[:n1] = 1.0
+    extreme = np.zeros(len(observed), dtype=np.int64)
+    drawn = 0
+    for size in _batch_sizes(resamples, n):
+        shuffled = rng.permuted(np.broadcast_to(labels, (size, n)), axis=1)
+        extreme += (extremeness(shuffled @ pooled, shuffled @ squares) >= threshold).sum(axis=0)
+        drawn += size
+        if early_stop and ((extreme >= early_stop) | np.isnan(observed)).all():
+            break
 
-        responders = population_data[population_data['response'].str.lower() == 'yes']['percentage']
-        non_responders = population_data[population_data['response'].str.lower() == 'no']['percentage']
+    p_values = (extreme + 1) / (drawn + 1)
+    return np.where(np.isnan(observed), np.nan, p_values), drawn
 
-        num_responders, num_non_responders = len(responders), len(non_responders)
+def _bootstrap_medians(values, counts):
+    # Median of each bootstrap sample, given how often it drew each value: the order statistics
+    # are found on the cumulative counts in sorted order, so no resample is ever sorted
+    n = len(values)
+    order = np.argsort(values)
+    cumulative = np.cumsum(counts[:, order], axis=1)
+    low = (cumulative < (n + 1) // 2).sum(axis=1)
+    high = (cumulative < n // 2 + 1).sum(axis=1)
+    return (values[order[low]] + values[order[high]]) / 2
 
-        # Calculate means and medians
-        if num_responders > 0 and num_non_responders > 0:
-            responder_mean = np.mean(responders)
-            responder_median = np.median(responders)
-            non_responder_mean = np.mean(non_responders)
-            non_responder_median = np.median(non_responders)
+def _bootstrap_u(responders, non_responders, counts1, counts2):
+    # Mann-Whitney U of each bootstrap sample from the draw counts: every responder value beats the
+    # non-responder draws below it and ties with those equal to it, both read off cumulative counts
+    order = np.argsort(non_responders)
+    cumulative = np.zeros((len(counts2), len(non_responders) + 1))
+    np.cumsum(counts2[:, order], axis=1, out=cumulative[:, 1:])
+    sorted_values = non_responders[order]
+    below = cumulative[:, np.searchsorted(sorted_values, responders, side='left')]
+    not_above = cumulative[:, np.searchsorted(sorted_values, responders, side='right')]
+    return (counts1 * (below + not_above) / 2).sum(axis=1)
+
+def _draw_counts(rng, n, size):
+    # How often each of n values is drawn by each of size bootstrap samples (a multinomial row). Counting
+    # uniform draws with one bincount over the whole batch is several times faster than rng.multinomial
+    draws = rng.integers(0, n, (size, n)) + np.arange(size)[:, None] * n
+    return np.bincount(draws.ravel(), minlength=size * n).reshape(size, n).astype(np.float64)
+
+def _bootstrap(responders, non_responders, is_normal, rng, resamples, confidence):
+    # Resamples each group with replacement. A bootstrap sample is stored as how often it drew each
+    # value, which turns the batch of means into one matrix product
+    n1, n2 = len(responders), len(non_responders)
+    n_populations = responders.shape[1]
+    estimates = {name: [] for name in ('mean difference', 'median difference', 'effect size')}
+
+    for size in _batch_sizes(resamples, n1 + n2):
+        counts1 = _draw_counts(rng, n1, size)
+        counts2 = _draw_counts(rng, n2, size)
+        mean1, mean2 = counts1 @ responders / n1, counts2 @ non_responders / n2
+        estimates['mean difference'].append(mean1 - mean2)
+
+        medians = np.empty((size, n_populations))
+        effect = np.empty((size, n_populations))
+        for p in range(n_populations):
+            medians[:, p] = (_bootstrap_medians(responders[:, p], counts1)
+                             - _bootstrap_medians(non_responders[:, p], counts2))
+            if not is_normal[p]:
+                u = _bootstrap_u(responders[:, p], non_responders[:, p], counts1, counts2)
+                effect[:, p] = 1 - (2 * u) / (n1 * n2)
+        estimates['median difference'].append(medians)
+
+        if is_normal.any():
+            var1 = (counts1 @ responders ** 2 - n1 * mean1 ** 2) / (n1 - 1)
+            var2 = (counts2 @ non_responders ** 2 - n2 * mean2 ** 2) / (n2 - 1)
+            std_pooled = np.sqrt(np.maximum(((n1 - 1) * var1 + (n2 - 1) * var2) / (n1 + n2 - 2), 0))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cohens_d = np.where(std_pooled > 0, (mean1 - mean2) / std_pooled, 0.0)
+            effect[:, is_normal] = cohens_d[:, is_normal]
+        estimates['effect size'].append(effect)
+
+    # Percentile intervals
+    tail = (1 - confidence) / 2
+    intervals = {}
+    for name, batches in estimates.items():
+        low, high = np.quantile(np.concatenate(batches), [tail, 1 - tail], axis=0)
+        intervals[f'{name} CI low'], intervals[f'{name} CI high'] = low, high
+    return intervals
+
+def _resample_cohort(responders, non_responders, is_normal, tested, resamples, bootstrap, confidence, early_stop, seed,
+                     key_hash):
+    # Every cohort draws from its own stream, derived from the seed and the cohort's key, so its
+    # results do not depend on the other cohorts in the batch or on which process ran it.
+    # Permutations and bootstrap use separate child streams, so early stopping cannot shift the bootstrap.
+    # The bootstrap always draws all of its samples, so its size is set apart from the permutations'
+    n_populations = responders.shape[1]
+    result = {col: np.full(n_populations, np.nan) for col in RESAMPLING_COLS if col != 'adjusted permutation p-value'}
+    result['permutations'] = np.zeros(n_populations, dtype=np.int64)
+    if not tested:
+        return result
+
+    result['mean difference'] = responders.mean(axis=0) - non_responders.mean(axis=0)
+    result['median difference'] = np.median(responders, axis=0) - np.median(non_responders, axis=0)
+
+    permutation_seed, bootstrap_seed = np.random.SeedSequence(seed, spawn_key=(key_hash,)).spawn(2)
+    p_values, drawn = _permutation_test(responders, non_responders, is_normal, np.random.default_rng(permutation_seed),
+                                        resamples, early_stop)
+    result['permutation p-value'] = p_values
+    result['permutations'][:] = drawn
+    if bootstrap:
+        result.update(_bootstrap(responders, non_responders, is_normal, np.random.default_rng(bootstrap_seed),
+                                 bootstrap, confidence))
+    return result
+
+def _cohort_key_hash(key):
+    # A stable 64-bit number per cohort key, the same in every process and run
+    text = '\x1f'.join(str(value) for value in key)
+    return int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], 'little')
+
+def adjust_p_values(p_values, groups, correction='bonferroni', num_tests=None):
+    # Multiple-testing correction within each group of tests. 'bonferroni' multiplies by num_tests
+    # (default: the number of p-values in the group); 'fdr' applies Benjamini-Hochberg. Missing p-values stay missing
+    from scipy.stats import false_discovery_control
+
+    p_values = np.asarray(p_values, dtype=np.float64)
+    adjusted = np.full(len(p_values), np.nan)
+    for group in pd.unique(groups):
+        mask = (groups == group) & ~np.isnan(p_values)
+        if not mask.any():
+            continue
+        if correction == 'bonferroni':
+            adjusted[mask] = np.minimum(p_values[mask] * (num_tests or mask.sum()), 1.0)
         else:
-            responder_mean = responder_median = non_responder_mean = non_responder_median = 0
-
-        # Normality test using Shapiro-Wilk
-        is_normal = False
-        if num_responders >= 3 and num_non_responders >= 3:
-            _, p_responders = stats.shapiro(responders)
-            _, p_non_responders = stats.shapiro(non_responders)
-            is_normal = (p_responders > 0.05) and (p_non_responders > 0.05)
-
-        p_value = None
-        test_used = "N/A"
-        effect_size = None
-        test_statistic = None
-
-        if num_responders > 1 and num_non_responders > 1:
-            if is_normal:
-                # If normal, use Welch's t-test
-                t_stat, p_value = stats.ttest_ind(responders, non_responders, equal_var=False)
-                test_used = "Welch's t-test"
-                test_statistic = t_stat
-
-                # Calculate Cohen's d
-                n1, n2 = num_responders, num_non_responders
-                var1 = np.var(responders, ddof=1)
-                var2 = np.var(non_responders, ddof=1)
-                std_pooled = np.sqrt(((n1 - 1) * var1 + (n2 - 1) * var2) / (n1 + n2 - 2))
-                effect_size = (responder_mean - non_responder_mean) / std_pooled if std_pooled > 0 else 0
-            else:
-                # If not normal, use Mann-Whitney U test
-                u_stat, p_value = stats.mannwhitneyu(responders, non_responders, alternative='two-sided')
-                test_used = "Mann-Whitney U"
-                test_statistic = u_stat
-
-                # Calculate rank-biserial correlation
-                effect_size = 1 - (2 * u_stat) / (num_responders * num_non_responders) if (num_responders * num_non_responders) > 0 else 0
-        
-        if p_value is not None:
-            adjusted_p_value = min(p_value * num_tests, 1.0)
+            adjusted[mask] = false_discovery_control(p_values[mask], method='bh')
+    return adjusted
+
+def _compare_cohort_slices(values, task):
+    (yes_start, yes_stop), (no_start, no_stop), resampling = task
+    return _compare_cohort(values[yes_start:yes_stop], values[no_start:no_stop], resampling)
+
+# Worker processes attach to the parent's array through shared memory instead of receiving a pickled copy
+_shared_values = None
+
+def _attach_shared_values(name, shape, dtype):
+    global _shared_values
+    memory = shared_memory.SharedMemory(name=name)
+    _shared_values = (memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf))
+
+def _compare_cohort_shared(task):
+    return _compare_cohort_slices(_shared_values[1], task)
+
+def _run_cohort_tasks_in_pool(values, tasks, workers, chunksize):
+    memory = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    shared = np.ndarray(values.shape, dtype=values.dtype, buffer=memory.buf)
+    try:
+        shared[:] = values
+
+        # map() returns results in task order, so the output matches the serial path exactly
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_shared_values,
+                                 initargs=(memory.name, values.shape, values.dtype)) as executor:
+            results = []
+            for result in executor.map(_compare_cohort_shared, tasks, chunksize=chunksize):
+                results.append(result)
+                report_progress(len(results), len(tasks), 'cohorts')
+            return results
+    finally:
+        del shared
+        memory.close()
+        memory.unlink()
+
+@instrumented
+def compute_batch_statistics(wide_df, group_by=(), cohorts=None, populations=None, correction_scope='cohort', alpha=0.05,
+                             workers=1, chunksize=8, measure='percentage', correction='bonferroni', resamples=0,
+                             confidence=0.95, early_stop=10, seed=0, bootstrap=None):
+    # Splits wide_df into cohorts by the group_by columns in a single groupby pass and compares
+    # responders with non-responders for every population of every cohort, on the {population}_{measure} columns.
+    # workers > 1 (or None for all CPUs) spreads the cohorts over a process pool, chunksize cohorts per task.
+    # correction is 'bonferroni' or 'fdr' (Benjamini-Hochberg). resamples > 0 adds permutation p-values and
+    # bootstrap confidence intervals (RESAMPLING_COLS), seeded per cohort so every run gives the same numbers.
+    # bootstrap sets the number of bootstrap samples (default: resamples; 0 leaves the intervals empty)
+    group_by = list(group_by)
+    populations = sorted(populations or POPULATIONS)
+    unknown = [col for col in group_by if col not in COHORT_COLS]
+    if unknown:
+        raise ValueError(f"Cannot group by {unknown}. Expected columns from {COHORT_COLS}")
+    if correction_scope not in ('cohort', 'all'):
+        raise ValueError("correction_scope must be 'cohort' or 'all'")
+    if correction not in ('bonferroni', 'fdr'):
+        raise ValueError("correction must be 'bonferroni' or 'fdr'")
+    if not 0 < confidence < 1:
+        raise ValueError("confidence must be between 0 and 1")
+    if bootstrap is None:
+        bootstrap = resamples
+
+    with span('transform'):
+        positions = {}
+        for key, index in wide_df.groupby(group_by + ['response'], observed=True, sort=True).indices.items():
+            key = key if isinstance(key, tuple) else (key,)
+            positions[key[:-1], key[-1]] = index
+
+        if cohorts is None:
+            cohort_keys = sorted({cohort for cohort, _ in positions})
         else:
-            adjusted_p_value = None
+            cohort_keys = [tuple(c) if isinstance(c, (list, tuple)) else (c,) for c in cohorts]
+
+        # Lay the rows out group by group so every cohort is two contiguous slices of one array;
+        # tasks then only carry slice bounds, whether they run here or in a worker process
+        order, tasks, offset = [], [], 0
+        for key in cohort_keys:
+            bounds = []
+            for response in ('yes', 'no'):
+                index = positions.get((key, response), np.array([], dtype=np.intp))
+                order.append(index)
+                bounds.append((offset, offset + len(index)))
+                offset += len(index)
+            resampling = (resamples, bootstrap, confidence, early_stop, seed, _cohort_key_hash(key)) if resamples else None
+            tasks.append((*bounds, resampling))
 
-        if adjusted_p_value is not None:
-            significant = adjusted_p_value < 0.05
+        value_cols = [f'{p}_{measure}' for p in populations]
+        values = wide_df[value_cols].to_numpy(dtype=np.float64)[np.concatenate(order) if order else []]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with span('stats'):
+        if workers > 1 and len(tasks) > 1:
+            results_per_cohort = _run_cohort_tasks_in_pool(values, tasks, workers, chunksize)
         else:
-            significant = False
-
-        statistical_results.append({
-            'population': population,
-            'test used': test_used,
-            'test statistic': round(test_statistic, 4) if test_statistic is not None else None,
-            'p-value': round(p_value, 4) if p_value is not None else None,
-            'adjusted p-value': round(adjusted_p_value, 4) if adjusted_p_value is not None else None,
-            'significant': significant,
-            'effect size': round(effect_size, 4) if effect_size is not None else None,
-            'responder mean': round(responder_mean, 2),
-            'responder median': round(responder_median, 2),
-            'non-responder mean': round(non_responder_mean, 2),
-            'non-responder median': round(non_responder_median, 2)
-        })
-    
-    return subset, pd.DataFrame(statistical_results)
+            results_per_cohort = []
+            for task in tasks:
+                results_per_cohort.append(_compare_cohort_slices(values, task))
+                report_progress(len(results_per_cohort), len(tasks), 'cohorts')
+
+    frames = []
+    for number, (key, result) in enumerate(zip(cohort_keys, results_per_cohort)):
+        frame = pd.DataFrame({'population': populations, **result})
+        for col, value in zip(group_by, key):
+            frame[col] = value
+        frame['cohort'] = number
+        frames.append(frame)
+
+    columns = group_by + STATISTICS_COLS + ['n responders', 'n non-responders'] + (RESAMPLING_COLS if resamples else [])
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    results = pd.concat(frames, ignore_index=True)
+
+    # Correction either within each cohort or across every test in the batch. Bonferroni within a
+    # cohort counts every population as a test, even those that could not be run
+    groups = results['cohort'].to_numpy() if correction_scope == 'cohort' else np.zeros(len(results))
+    num_tests = len(populations) if correction == 'bonferroni' and correction_scope == 'cohort' else None
+    results['adjusted p-value'] = adjust_p_values(results['p-value'], groups, correction, num_tests)
+    significant_from = 'adjusted p-value'
+    if resamples:
+        results['adjusted permutation p-value'] = adjust_p_values(results['permutation p-value'], groups, correction,
+                                                                  num_tests)
+        significant_from = 'adjusted permutation p-value'
+    results['significant'] = (results[significant_from] < alpha).to_numpy()
+
+    for col in ['test statistic', 'p-value', 'adjusted p-value', 'effect size']:
+        results[col] = results[col].round(4)
+    for col in ['responder mean', 'responder median', 'non-responder mean', 'non-responder median']:
+        results[col] = results[col].round(2)
+    if resamples:
+        for col in ['permutation p-value', 'adjusted permutation p-value', 'effect size CI low', 'effect size CI high']:
+            results[col] = results[col].round(4)
+        for col in RESAMPLING_COLS[3:9]:
+            results[col] = results[col].round(2)
+
+    return results[columns]
+
+@instrumented
+@cached
+def get_batch_statistics(group_by=('condition', 'treatment', 'sample_type', 'time_from_treatment_start'), cohorts=None,
+                         populations=None, correction_scope='cohort', alpha=0.05, workers=1, chunksize=8,
+                         correction='bonferroni', resamples=0, confidence=0.95, early_stop=10, seed=0, bootstrap=None,
+                         **filters):
+    # Filters are pushed into SQL; the data is read once for all cohorts
+    wide_df = get_frequency_wide(**filters)
+    return compute_batch_statistics(wide_df, group_by, cohorts, populations, correction_scope, alpha, workers, chunksize,
+                                    correction=correction, resamples=resamples, confidence=confidence,
+                                    early_stop=early_stop, seed=seed, bootstrap=bootstrap)
+
+# The cohort analysed on the statistics tab
+STATISTICS_FILTERS = {
+    'condition': 'melanoma',
+    'treatment': 'miraclib',
+    'sample_type': 'PBMC',
+}
+
+@instrumented
+@cached
+def get_statistics(correction='bonferroni', resamples=0, confidence=0.95, early_stop=10, seed=0, bootstrap=None):
+    # Only the melanoma / miraclib / PBMC cohort is fetched from the database
+    wide_df = get_frequency_wide(**STATISTICS_FILTERS)
+    with span('transform'):
+        subset = to_long_format(wide_df)
+
+    statistics = compute_batch_statistics(wide_df, correction=correction, resamples=resamples, confidence=confidence,
+                                          early_stop=early_stop, seed=seed, bootstrap=bootstrap)
+    return subset, statistics[STATISTICS_COLS + (RESAMPLING_COLS if resamples else [])]
+
+# Box plot summaries: quartiles, whiskers and a capped set of outliers and points per population
+# and response, so figures carry summary statistics instead of every sample
+BOX_MAX_OUTLIERS = 200
+BOX_MAX_POINTS = 300
+
+def _evenly_spaced(values, cap):
+    # Keeps the smallest and largest values when thinning a sorted array
+    if len(values) <= cap:
+        return values
+    return values[np.linspace(0, len(values) - 1, cap).round().astype(int)]
+
+@instrumented
+@cached
+def get_box_summary(max_outliers=BOX_MAX_OUTLIERS, max_points=BOX_MAX_POINTS, seed=0, **filters):
+    filters = filters or STATISTICS_FILTERS
+    wide_df = get_frequency_wide(**filters)
+    populations = sorted(POPULATIONS)
+    values = wide_df[[f'{p}_percentage' for p in populations]].to_numpy(dtype=np.float64)
+    rng = np.random.default_rng(seed)
+
+    with span('stats'):
+        rows = []
+        for response, index in sorted(wide_df.groupby('response', observed=True).indices.items()):
+            group = values[index]
+
+            # Same linear quartile method plotly uses when it computes boxes itself
+            q1, median, q3 = np.percentile(group, [25, 50, 75], axis=0)
+            iqr = q3 - q1
+            low, high = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+            inside = (group >= low) & (group <= high)
+            lowerfence = np.where(inside, group, np.inf).min(axis=0)
+            upperfence = np.where(inside, group, -np.inf).max(axis=0)
+            means = group.mean(axis=0)
+
+            # The jittered points are one random sample of rows per response group, shared by all populations
+            sampled = np.sort(rng.choice(len(group), size=min(max_points, len(group)), replace=False))
+
+            for i, population in enumerate(populations):
+                rows.append({
+                    'population': population,
+                    'response': response,
+                    'n': len(group),
+                    'q1': q1[i],
+                    'median': median[i],
+                    'q3': q3[i],
+                    'lowerfence': lowerfence[i],
+                    'upperfence': upperfence[i],
+                    'mean': means[i],
+                    'outliers': _evenly_spaced(np.sort(group[~inside[:, i], i]), max_outliers),
+                    'points': group[sampled, i],
+                })
+
+    return pd.DataFrame(rows)
+
+# Longitudinal analysis: every subject's samples are pivoted once into one row per subject and
+# timepoint, with each population's frequency and its change from that subject's baseline
+TRAJECTORY_COLS = ['subject', 'project', 'condition', 'treatment', 'response', 'sample_type', 'sex', 'time_from_treatment_start']
+
+@instrumented
+def compute_trajectories(wide_df, populations=None, baseline_time=0):
+    populations = sorted(populations or POPULATIONS)
+    subject_codes, subjects = pd.factorize(wide_df['subject'], sort=True)
+    time_codes, times = pd.factorize(wide_df['time_from_treatment_start'], sort=True)
+    values = wide_df[[f'{p}_percentage' for p in populations]].to_numpy(dtype=np.float64)
+
+    # One cell per (subject, timepoint) that has samples, ordered by subject then time;
+    # repeated samples at the same timepoint are averaged
+    cells, inverse = np.unique(subject_codes * len(times) + time_codes, return_inverse=True)
+    cell_subject, cell_time = np.divmod(cells, len(times))
+    counts = np.bincount(inverse, minlength=len(cells))
+    frequency = np.column_stack([
+        np.bincount(inverse, weights=values[:, i], minlength=len(cells)) / counts for i in range(len(populations))
+    ])
+
+    # Baseline per subject, NaN for subjects without a baseline sample
+    baseline = np.full((len(subjects), len(populations)), np.nan)
+    if baseline_time in times:
+        at_baseline = cell_time == times.get_loc(baseline_time)
+        baseline[cell_subject[at_baseline]] = frequency[at_baseline]
+    change = frequency - baseline[cell_subject]
+
+    # Subject metadata does not change over time, so it is taken from each subject's first sample
+    first_sample = np.unique(subject_codes, return_index=True)[1]
+    trajectories = wide_df[TRAJECTORY_COLS[:-1]].iloc[first_sample[cell_subject]].reset_index(drop=True)
+    trajectories['time_from_treatment_start'] = np.asarray(times)[cell_time]
+    trajectories['n_samples'] = counts.astype(np.int32)
+    for i, population in enumerate(populations):
+        trajectories[f'{population}_percentage'] = frequency[:, i].round(2)
+        trajectories[f'{population}_change'] = change[:, i].round(2)
+    return trajectories
+
+@instrumented
+@cached
+def get_trajectories(long=True, populations=None, baseline_time=0, **filters):
+    # A timepoint filter is applied after the pivot, so the change is still relative to the baseline
+    times = filters.pop('time_from_treatment_start', None)
+    trajectories = compute_trajectories(get_frequency_wide(**filters), populations, baseline_time)
+    if times is not None:
+        times = list(times) if isinstance(times, (list, tuple, set)) else [times]
+        trajectories = trajectories[trajectories['time_from_treatment_start'].isin(times)].reset_index(drop=True)
+    if not long:
+        return trajectories
+
+    populations = sorted(populations or POPULATIONS)
+    n = len(trajectories)
+    with span('transform'):
+        result = trajectories[TRAJECTORY_COLS].iloc[np.repeat(np.arange(n), len(populations))].reset_index(drop=True)
+        result['population'] = pd.Categorical.from_codes(np.tile(np.arange(len(populations), dtype=np.int8), n), populations)
+        for measure in ('percentage', 'change'):
+            result[measure] = trajectories[[f'{p}_{measure}' for p in populations]].to_numpy().ravel()
+    return result
+
+@instrumented
+@cached
+def get_longitudinal_statistics(group_by=('condition', 'treatment', 'sample_type'), measure='change', populations=None,
+                                baseline_time=0, correction_scope='cohort', alpha=0.05, workers=1, chunksize=8,
+                                correction='bonferroni', resamples=0, confidence=0.95, early_stop=10, seed=0,
+                                bootstrap=None, **filters):
+    # Responders vs. non-responders at every timepoint of every cohort, on either the frequency ('percentage')
+    # or its change from baseline ('change'), in a single batch over the shared subject pivot
+    if measure not in ('percentage', 'change'):
+        raise ValueError("measure must be 'percentage' or 'change'")
+    trajectories = get_trajectories(False, populations, baseline_time, **filters)
+    if measure == 'change':
+        # The baseline itself has no change, and subjects without a baseline have nothing to compare against
+        change_cols = [f'{p}_change' for p in sorted(populations or POPULATIONS)]
+        trajectories = trajectories[trajectories['time_from_treatment_start'] != baseline_time].dropna(subset=change_cols)
+
+    group_by = list(group_by) + ['time_from_treatment_start']
+    return compute_batch_statistics(trajectories, group_by, None, populations, correction_scope, alpha, workers,
+                                    chunksize, measure, correction, resamples, confidence, early_stop, seed, bootstrap)
 
 # Part 4
-def get_specific_subset_data():
-    with sqlite3.connect(DB_name) as con:
-        query = '''
-            SELECT subjects.project, subjects.response, subjects.sex, samples.sample
-            FROM samples
-            JOIN subjects ON samples.subject = subjects.subject
-            WHERE subjects.condition = 'melanoma'
-              AND subjects.sample_type = 'PBMC'
-              AND subjects.treatment = 'miraclib'
-              AND samples.time_from_treatment_start = 0
-        '''
-        df = pd.read_sql_query(query, con)
-    return df
+# The baseline cohort: melanoma patients on miraclib, PBMC samples at time 0
+BASELINE_FILTERS = {
+    'condition': 'melanoma',
+    'sample_type': 'PBMC',
+    'treatment': 'miraclib',
+    'time_from_treatment_start': 0,
+}
+
+SUBSET_QUERY = '''
+    SELECT subjects.project, subjects.response, subjects.sex, samples.sample
+    FROM samples
+    JOIN subjects ON samples.subject_id = subjects.subject_id
+'''
+
+@instrumented
+@cached
+def get_specific_subset_data(**filters):
+    # Extra filters (e.g. project, sex, response) narrow the baseline cohort further
+    if storage_backend == 'parquet':
+        return _read_parquet(['project', 'response', 'sex', 'sample'], {**BASELINE_FILTERS, **filters}, sort_by='sample')
+
+    where, params = build_filter_clause({**BASELINE_FILTERS, **filters})
+    with span('query'), read_connection() as con:
+        df = pd.read_sql_query(f"{SUBSET_QUERY} {where} ORDER BY samples.sample", con, params=params)
+    return _compact(df)
+
+@instrumented
+@cached(disk=False)
+def get_specific_subset_page(page_current=0, page_size=20, **filters):
+    # One page of the baseline cohort; the total comes from the cohort summary instead of a COUNT over samples
+    where, params = build_filter_clause({**BASELINE_FILTERS, **filters})
+    with span('query'), read_connection() as con:
+        page = pd.read_sql_query(
+            f"{SUBSET_QUERY} {where} ORDER BY samples.sample LIMIT ? OFFSET ?",
+            con, params=params + [page_size, page_current * page_size]
+        )
+    total_rows = int(get_cohort_counts(**{**BASELINE_FILTERS, **filters})['sample_count'].sum())
+    return page, total_rows
+
+# Cohort sizes straight from cohort_summary, which is small enough that no caching is needed
+SUMMARY_FILTER_COLUMNS = {col: f'cohort_summary.{col}' for col in SUMMARY_COLS}
+
+@instrumented
+def get_cohort_counts(group_by=(), **filters):
+    group_by = list(group_by)
+    unknown = [col for col in group_by if col not in SUMMARY_COLS]
+    if unknown:
+        raise ValueError(f"Cannot group by {unknown}. Expected columns from {SUMMARY_COLS}")
+
+    where, params = build_filter_clause(filters, SUMMARY_FILTER_COLUMNS)
+    select = ', '.join(group_by + ['SUM(sample_count) AS sample_count'])
+    group = f"GROUP BY {', '.join(group_by)}" if group_by else ''
+
+    with span('query'), read_connection() as con:
+        df = pd.read_sql_query(f"SELECT {select} FROM cohort_summary {where} {group}", con, params=params)
+
+    # Missing metadata is stored as '' in the summary
+    df['sample_count'] = df['sample_count'].fillna(0).astype(int)
+    return df.replace({col: {'': None} for col in group_by})
 
 # Average b-cell question
+AVERAGE_B_CELL_FILTERS = {
+    'condition': 'melanoma',
+    'sex': 'M',
+    'response': 'yes',
+    'time_from_treatment_start': 0,
+}
+
+AVERAGE_B_CELL_QUERY = '''
+    SELECT AVG(samples.b_cell)
+    FROM samples
+    JOIN subjects ON samples.subject_id = subjects.subject_id
+'''
+
+@instrumented
+@cached
 def get_average_b_cell():
-    with sqlite3.connect(DB_name) as con:
-        query = '''
-            SELECT AVG(samples.b_cell)
-            FROM samples
-            JOIN subjects ON samples.subject = subjects.subject
-            WHERE subjects.condition = 'melanoma'
-              AND subjects.sex = 'M'
-              AND subjects.response = 'yes'
-              AND samples.time_from_treatment_start = 0
-        '''
-        result = pd.read_sql_query(query, con)
+    if storage_backend == 'parquet':
+        return _read_parquet(['b_cell'], AVERAGE_B_CELL_FILTERS)['b_cell'].mean()
+
+    where, params = build_filter_clause(AVERAGE_B_CELL_FILTERS)
+    with span('query'), read_connection() as con:
+        result = pd.read_sql_query(f"{AVERAGE_B_CELL_QUERY} {where}", con, params=params)
     return result.iloc[0, 0]
 
+# Parquet storage
+# Samples can also be served from a Parquet dataset partitioned by project, joined with their
+# subject metadata, so the analytical queries read only the partitions and columns they need.
+# SQLite stays the system of record for ingest, the cohort summary and the paged table views.
+STORAGE_BACKENDS = ('sqlite', 'parquet')
+storage_backend = 'sqlite'
+PARQUET_DIR = 'samples_parquet'
+
+def _parquet_schema():
+    import pyarrow as pa
+
+    metadata = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [('sample', pa.string()), ('subject', pa.string()), ('time_from_treatment_start', pa.int32())]
+        + [(p, pa.int32()) for p in POPULATIONS]
+        + [('condition', metadata), ('age', pa.int32()), ('sex', metadata), ('treatment', metadata),
+           ('response', metadata), ('sample_type', metadata), ('project', pa.string())]
+    )
+
+# Each export is written to its own directory, PARQUET_DIR/v<data version>, and the CURRENT file names the
+# live one. Readers in other threads and processes may still be reading an export after it is replaced, so
+# replaced exports are only deleted once they have not been current for PARQUET_KEEP_SECONDS
+PARQUET_KEEP_SECONDS = 600
+
+def _parquet_current():
+    try:
+        with open(os.path.join(PARQUET_DIR, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def _parquet_version():
+    current = _parquet_current()
+    return current[1:] if current else None
+
+def _parquet_dataset():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    # A load in another process (e.g. `python backend.py load`) moves the data version on without
+    # touching the files, so a stale dataset is re-exported before it is read. The version includes the
+    # database id, so an export of a deleted database is stale too, whatever its user_version
+    if _parquet_version() != get_data_version():
+        sync_parquet()
+
+    partitioning = ds.partitioning(pa.schema([('project', pa.string())]), flavor='hive')
+    return ds.dataset(os.path.join(PARQUET_DIR, _parquet_current()), schema=_parquet_schema(), format='parquet',
+                      partitioning=partitioning)
+
+_parquet_lock = threading.Lock()
+
+@instrumented
+def sync_parquet(chunksize=CHUNK_SIZE):
+    # Writes a new export from SQLite when the live one was exported from an older data version
+    with _parquet_lock:
+        _sync_parquet(chunksize)
+
+def _sync_parquet(chunksize):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    data_version = get_data_version()
+    previous = _parquet_current()
+    if previous == f"v{data_version}":
+        return
+
+    schema = _parquet_schema()
+    query = f'''
+        SELECT {', '.join('subjects.subject' if c == 'subject' else f"samples.{c}" for c in SAMPLE_COLS)},
+            {', '.join(f"subjects.{c}" for c in SUBJECT_COLS if c != 'subject')}
+        FROM samples
+        JOIN subjects ON samples.subject_id = subjects.subject_id
+        ORDER BY subjects.project, samples.sample
+    '''
+
+    def batches():
+        with read_connection() as con:
+            for chunk in pd.read_sql_query(query, con, chunksize=chunksize):
+                yield pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False)
+
+    # Written under a temporary name and renamed once complete, so a version directory is never partial
+    version_dir = os.path.join(PARQUET_DIR, f"v{data_version}")
+    if not os.path.isdir(version_dir):
+        tmp_dir = f"{version_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        ds.write_dataset(
+            batches(), tmp_dir, schema=schema, format='parquet',
+            partitioning=ds.partitioning(pa.schema([('project', pa.string())]), flavor='hive'),
+            existing_data_behavior='overwrite_or_ignore'
+        )
+        try:
+            os.rename(tmp_dir, version_dir)
+        except OSError:
+            # Another worker exported the same version first; this copy was never read
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if get_data_version() != data_version:
+        # A load committed during the export; never switch readers back to an older version
+        return _sync_parquet(chunksize)
+
+    # Switch readers over by replacing the pointer file in one step. The new export's mtime is set first,
+    # so _remove_old_parquet() in another process does not take it for an old one before the switch
+    os.utime(version_dir)
+    pointer = os.path.join(PARQUET_DIR, 'CURRENT')
+    tmp_pointer = f"{pointer}.tmp-{os.getpid()}"
+    with open(tmp_pointer, 'w') as f:
+        f.write(f"v{data_version}")
+    os.replace(tmp_pointer, pointer)
+    if previous is not None and os.path.isdir(os.path.join(PARQUET_DIR, previous)):
+        # Marks when the old export stopped being current, for _remove_old_parquet()
+        os.utime(os.path.join(PARQUET_DIR, previous))
+    _remove_old_parquet()
+    print(f"Parquet dataset '{PARQUET_DIR}' exported at data version {data_version}.")
+
+def _remove_old_parquet():
+    # Deletes exports (and files of the old single-directory layout) that stopped being current more
+    # than PARQUET_KEEP_SECONDS ago, and exports left half-written by processes that died
+    current = _parquet_current()
+    cutoff = time.time() - PARQUET_KEEP_SECONDS
+    for name in os.listdir(PARQUET_DIR):
+        path = os.path.join(PARQUET_DIR, name)
+        if name in (current, 'CURRENT'):
+            continue
+        if '.tmp-' in name:
+            if _process_alive(int(name.rsplit('-', 1)[1])):
+                continue
+        else:
+            try:
+                if os.stat(path).st_mtime > cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+def set_storage_backend(name, parquet_dir=None):
+    global storage_backend, PARQUET_DIR
+    if name not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend '{name}'. Expected one of {STORAGE_BACKENDS}")
+    if parquet_dir is not None:
+        PARQUET_DIR = parquet_dir
+    if name == 'parquet':
+        sync_parquet()
+    storage_backend = name
+
+def _parquet_filter(filters):
+    import pyarrow.dataset as ds
+
+    expression = None
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if name not in FILTER_COLUMNS:
+            raise ValueError(f"Unknown filter '{name}'. Expected one of {list(FILTER_COLUMNS)}")
+        values = [normalize_value(name, v) for v in (value if isinstance(value, (list, tuple, set)) else [value])]
+        term = ds.field(name).isin(values)
+        expression = term if expression is None else expression & term
+    return expression
+
+def _read_parquet(columns, filters, sort_by=None):
+    # Only the requested columns are decoded, and the filter prunes project partitions and row groups
+    table = _parquet_dataset().to_table(columns=columns, filter=_parquet_filter(filters))
+    if sort_by is not None:
+        table = table.sort_by(sort_by)
+
+    # Dictionary columns arrive as categoricals already; the rest is converted as on the SQLite path
+    return _compact(table.to_pandas())
+
+# Query plan check: filtered queries must be answered through indexes, never by scanning a whole table
+def find_full_scans(queries=None):
+    # Maps a name to a (query, params) pair
+    if queries is None:
+        filtered_frequency = build_filter_clause({'condition': 'melanoma', 'treatment': 'miraclib', 'sample_type': 'PBMC'})
+        baseline = build_filter_clause(BASELINE_FILTERS)
+        average_b_cell = build_filter_clause(AVERAGE_B_CELL_FILTERS)
+        queries = {
+            'get_specific_subset_data': (f"{SUBSET_QUERY} {baseline[0]}", baseline[1]),
+            'get_average_b_cell': (f"{AVERAGE_B_CELL_QUERY} {average_b_cell[0]}", average_b_cell[1]),
+            'get_frequency (filtered)': (f"{FREQUENCY_QUERY} {filtered_frequency[0]}", filtered_frequency[1]),
+        }
+
+    full_scans = {}
+    with read_connection() as con:
+        for name, (query, params) in queries.items():
+            plan = [row[3] for row in con.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+            # SCAN ... USING [COVERING] INDEX still reads the whole index, so every SCAN step counts
+            scans = [step for step in plan if step.startswith('SCAN')]
+            if scans:
+                full_scans[name] = scans
+    return full_scans
+
+# Background jobs: long analyses and exports run in a local process pool instead of inside the request.
+# Jobs are rows of an on-disk SQLite table shared by every worker process, keyed on the job kind, its
+# parameters and the data version, so an identical request joins the job already queued or running and a
+# finished result is reused until new data is loaded. No broker is involved: the process that queues a job
+# runs it in its own pool, and a job whose process has died is run again on the next submit.
+JOBS_DB = os.environ.get('JOBS_DB', 'jobs.db')
+JOBS_DIR = os.environ.get('JOBS_DIR', 'job_results')
+# Job workers run at a lower CPU priority and leave a core to the interactive callbacks
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', max(1, (os.cpu_count() or 1) - 1)))
+JOB_NICENESS = 10
+JOB_PROGRESS_INTERVAL = 0.5
+
+JOBS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    data_version TEXT NOT NULL,
+    status TEXT NOT NULL CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    error TEXT,
+    pid INTEGER,
+    result_path TEXT,
+    submitted REAL,
+    started REAL,
+    finished REAL
+)'''
+
+def write_frequency_csv(path, chunksize=CHUNK_SIZE):
+    with read_connection() as con:
+        total = con.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+    with open(path, 'w', newline='') as f:
+        for number, text in enumerate(iter_frequency_csv(chunksize), start=1):
+            f.write(text)
+            report_progress(min(number * chunksize, total), total, 'samples exported')
+
+def write_baseline_csv(path, **filters):
+    get_specific_subset_data(**filters).to_csv(path, index=False)
+
+# Job kinds: the function and the file its result is kept in. Statistics results are pickled frames;
+# export functions write their CSV to the path they are given
+JOB_KINDS = {
+    'batch_statistics': (get_batch_statistics, '.pkl'),
+    'longitudinal_statistics': (get_longitudinal_statistics, '.pkl'),
+    'frequency_csv': (write_frequency_csv, '.csv'),
+    'baseline_csv': (write_baseline_csv, '.csv'),
+}
+
+@contextlib.contextmanager
+def jobs_connection():
+    # Job calls are rare next to queries (a submit, a poll every second), so they connect per call
+    con = sqlite3.connect(JOBS_DB, timeout=60, isolation_level=None)
+    try:
+        con.execute("PRAGMA journal_mode = WAL")
+        con.execute(JOBS_SCHEMA)
+        con.row_factory = sqlite3.Row
+        yield con
+    finally:
+        con.close()
+
+def _job_id(kind, params, data_version):
+    # data_version carries the database id, so a recreated database at the same path and user_version
+    # does not get the results of the file it replaced
+    key = json.dumps([kind, params, data_version, os.path.abspath(DB_name), storage_backend], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+def _needs_run(row):
+    # New and failed jobs run; so do jobs whose process died and results whose file has gone
+    if row is None or row['status'] == 'failed':
+        return True
+    if row['status'] == 'done':
+        return not os.path.exists(row['result_path'])
+    return not _process_alive(row['pid'])
+
+_job_executor = None
+_job_executor_key = None
+_job_executor_lock = threading.Lock()
+
+def _init_job_worker(db_name, cache_max_bytes, cache_dir, cache_disk_max_bytes, backend_name, parquet_dir):
+    # Workers are spawned fresh rather than forked from a threaded server, so they take over its settings here
+    global DB_name, PARQUET_DIR, storage_backend
+    DB_name, PARQUET_DIR, storage_backend = db_name, parquet_dir, backend_name
+    configure_cache(cache_max_bytes, cache_dir, cache_disk_max_bytes)
+    os.nice(JOB_NICENESS)
+
+def _job_pool():
+    global _job_executor, _job_executor_key
+    key = (os.getpid(), DB_name, result_cache.max_bytes, result_cache.disk_dir, result_cache.disk_max_bytes,
+           storage_backend, PARQUET_DIR)
+    with _job_executor_lock:
+        if _job_executor is None or _job_executor_key != key:
+            if _job_executor is not None and _job_executor_key[0] == key[0]:
+                _job_executor.shutdown(wait=False)
+            _job_executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_init_job_worker, initargs=key[1:])
+            _job_executor_key = key
+            prune_jobs()
+        return _job_executor
+
+def _job_finished(job_id, future):
+    # A job that raised is recorded by _run_job; this catches workers that died (e.g. killed for memory)
+    global _job_executor
+    error = future.exception()
+    if error is None:
+        return
+    if isinstance(error, BrokenProcessPool):
+        with _job_executor_lock:
+            _job_executor = None
+    with jobs_connection() as con:
+        con.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE job_id = ? AND status IN ('queued', 'running')",
+                    (f"{type(error).__name__}: {error}", time.time(), job_id))
+
+def submit_job(kind, **params):
+    # Returns the job's id. An identical job that is queued, running or done is reused rather than run again
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind '{kind}'. Expected one of {list(JOB_KINDS)}")
+    params = json.loads(json.dumps(params))  # tuples and lists give the same job
+    data_version = get_data_version()
+    job_id = _job_id(kind, params, data_version)
+
+    with jobs_connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        row = con.execute("SELECT status, pid, result_path FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        run = _needs_run(row)
+        if run:
+            con.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, kind, params, data_version, status, pid, submitted) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, json.dumps(params), data_version, os.getpid(), time.time())
+            )
+        con.execute("COMMIT")
+
+    if run:
+        _job_pool().submit(_run_job, job_id).add_done_callback(functools.partial(_job_finished, job_id))
+    return job_id
+
+_current_job = None
+_last_progress = 0.0
+
+def report_progress(done, total, message=None):
+    # Called from long loops; records progress when they run inside a job and does nothing otherwise
+    global _last_progress
+    if _current_job is None:
+        return
+    now = time.monotonic()
+    if done < total and now - _last_progress < JOB_PROGRESS_INTERVAL:
+        return
+    _last_progress = now
+    with jobs_connection() as con:
+        con.execute("UPDATE jobs SET progress = ?, message = ? WHERE job_id = ?",
+                    (done / total if total else 1.0, f"{done:,} of {total:,} {message}" if message else None, _current_job))
+
+def _run_job(job_id):
+    global _current_job
+    with jobs_connection() as con:
+        # Claiming the row makes sure a job is only ever run once, whichever process queued it
+        claimed = con.execute("UPDATE jobs SET status = 'running', pid = ?, started = ?, progress = 0 "
+                              "WHERE job_id = ? AND status = 'queued'", (os.getpid(), time.time(), job_id)).rowcount
+        row = con.execute("SELECT kind, params FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    if not claimed:
+        return
+
+    func, suffix = JOB_KINDS[row['kind']]
+    params = json.loads(row['params'])
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    path = os.path.join(os.path.abspath(JOBS_DIR), f"{job_id}{suffix}")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    _current_job = job_id
+    try:
+        with span('job', f"job:{row['kind']}"):
+            if suffix == '.csv':
+                func(tmp_path, **params)
+            else:
+                pd.to_pickle(func(**params), tmp_path)
+        os.replace(tmp_path, path)
+    except Exception as error:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with jobs_connection() as con:
+            con.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE job_id = ?",
+                        (f"{type(error).__name__}: {error}", time.time(), job_id))
+        return
+    finally:
+        _current_job = None
+
+    with jobs_connection() as con:
+        con.execute("UPDATE jobs SET status = 'done', progress = 1, message = NULL, result_path = ?, finished = ? "
+                    "WHERE job_id = ?", (path, time.time(), job_id))
+
+def get_job(job_id):
+    # The job's row as a dict, or None for an unknown id. A job whose process died is reported as failed
+    with jobs_connection() as con:
+        row = con.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is not None and row['status'] in ('queued', 'running') and not _process_alive(row['pid']):
+            con.execute("UPDATE jobs SET status = 'failed', error = 'The process running this job exited', finished = ? "
+                        "WHERE job_id = ? AND status = ?", (time.time(), job_id, row['status']))
+            row = con.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    return job
+
+def job_result(job_id):
+    # The statistics frame of a finished statistics job, or the CSV path of a finished export
+    job = get_job(job_id)
+    if job is None or job['status'] != 'done':
+        return None
+    if job['result_path'].endswith('.csv'):
+        return job['result_path']
+    return pd.read_pickle(job['result_path'])
+
+def prune_jobs(max_age=None):
+    # Finished jobs from older data versions, or from a database that has since been replaced, can never be
+    # reused; max_age (seconds) also drops older results
+    data_version = get_data_version()
+    cutoff = time.time() - max_age if max_age is not None else None
+    with jobs_connection() as con:
+        rows = con.execute("SELECT job_id, result_path FROM jobs WHERE status IN ('done', 'failed') "
+                           "AND (data_version != ? OR finished < ?)", (data_version, cutoff)).fetchall()
+        for row in rows:
+            if row['result_path'] and os.path.exists(row['result_path']):
+                os.remove(row['result_path'])
+            con.execute("DELETE FROM jobs WHERE job_id = ?", (row['job_id'],))
+    return len(rows)
+
 if __name__ == "__main__":
-    initialize_database()
-    load_data(csv_file)
-    print(get_frequency())
-    print(get_statistics())
-    print(get_specific_subset_data())
-    print(f"Average b_cell count: {get_average_b_cell()}")
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load the cell count data and print the analysis.")
+    parser.add_argument('command', nargs='?', choices=['report', 'load'], default='report',
+                        help="'load' only ingests the CSV (a one-time step before starting the dashboard)")
+    parser.add_argument('--csv', default=csv_file)
+    parser.add_argument('--reset', action='store_true', help="Drop and rebuild the tables before loading")
+    args = parser.parse_args()
+
+    initialize_database(reset=args.reset)
+    load_data(args.csv)
+
+    if args.command == 'report':
+        print(get_frequency())
+        print(get_statistics())
+        print(get_specific_subset_data())
+        print(f"Average b_cell count: {get_average_b_cell()}")
+        print(f"Full table scans: {find_full_scans() or 'none'}")
@@ -0,0 +1,509 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+import backend
+
+DEFAULT_ROWS = [1_000_000, 10_000_000, 50_000_000]
+TIMEPOINTS = [0, 7, 14]
+
+
+# Synthetic data in the cell-count.csv schema. The size is set by rows or by subjects; each subject has
+# samples_per_subject samples that cycle through the timepoints, spread evenly over the projects
+def generate_csv(path, rows=None, seed=0, chunksize=1_000_000, projects=3, subjects=None, samples_per_subject=None,
+                 timepoints=TIMEPOINTS):
+    rng = np.random.default_rng(seed)
+    timepoints = np.asarray(timepoints)
+    samples_per_subject = samples_per_subject or len(timepoints)
+    if subjects is None:
+        subjects = -(-rows // samples_per_subject)
+    if rows is None:
+        rows = subjects * samples_per_subject
+
+    # Subject level attributes are drawn once up front so they stay consistent across chunks
+    n_subjects = subjects
+    subject_ages = rng.integers(20, 90, n_subjects, dtype=np.int8)
+    subject_codes = {
+        'sex': (np.array(['M', 'F']), rng.integers(0, 2, n_subjects, dtype=np.int8)),
+        'condition': (np.array(['melanoma', 'carcinoma', 'healthy']), rng.integers(0, 3, n_subjects, dtype=np.int8)),
+        'treatment': (np.array(['miraclib', 'phauximab', 'none']), rng.integers(0, 3, n_subjects, dtype=np.int8)),
+        'response': (np.array(['yes', 'no']), rng.integers(0, 2, n_subjects, dtype=np.int8)),
+        'sample_type': (np.array(['PBMC', 'WB']), rng.integers(0, 2, n_subjects, dtype=np.int8)),
+    }
+
+    written = 0
+    first = True
+    while written < rows:
+        n = min(chunksize, rows - written)
+        index = np.arange(written, written + n)
+        subject_index = index // samples_per_subject % n_subjects
+        attrs = {name: values[codes[subject_index]] for name, (values, codes) in subject_codes.items()}
+
+        df = pd.DataFrame({
+            'project': np.char.add('prj', (subject_index % projects + 1).astype(str)),
+            'subject': np.char.add('sbj', subject_index.astype(str)),
+            'condition': attrs['condition'],
+            'age': subject_ages[subject_index],
+            'sex': attrs['sex'],
+            'treatment': attrs['treatment'],
+            'response': attrs['response'],
+            'sample': np.char.add('sample', index.astype(str)),
+            'sample_type': attrs['sample_type'],
+            'time_from_treatment_start': timepoints[index % samples_per_subject % len(timepoints)],
+            'b_cell': rng.integers(1000, 20000, n),
+            'cd8_t_cell': rng.integers(5000, 40000, n),
+            'cd4_t_cell': rng.integers(5000, 40000, n),
+            'nk_cell': rng.integers(1000, 30000, n),
+            'monocyte': rng.integers(5000, 40000, n),
+        })
+        df.to_csv(path, mode='w' if first else 'a', header=first, index=False)
+        written += n
+        first = False
+
+
+def synthetic_csv(workdir, rows, **options):
+    # Generated once per size and generator options, then reused by every benchmark. Options left as
+    # None take generate_csv()'s defaults; the others are part of the file name
+    options = {key: value for key, value in options.items() if value is not None}
+    suffix = ''.join(f'-{key}={value}' for key, value in sorted(options.items()) if value is not None)
+    csv_path = os.path.join(workdir, f'cells-{rows}{suffix.replace(" ", "")}.csv')
+    if not os.path.exists(csv_path):
+        print(f"Generating {rows:,} rows...")
+        generate_csv(csv_path, rows, **options)
+    return csv_path
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Runs in a fresh process so peak RSS reflects only the load
+def run_load(csv_path, db_path, chunksize):
+    backend.DB_name = db_path
+    backend.initialize_database(reset=True)
+
+    start = time.perf_counter()
+    backend.load_data(csv_path, incremental=False, chunksize=chunksize)
+    elapsed = time.perf_counter() - start
+
+    print(json.dumps({'seconds': elapsed, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def benchmark_load(rows, chunksize, workdir, **generator_options):
+    csv_path = synthetic_csv(workdir, rows, **generator_options)
+    db_path = os.path.splitext(csv_path)[0] + '.db'
+
+    output = subprocess.run(
+        [sys.executable, __file__, 'load-worker', csv_path, db_path, str(chunksize)],
+        check=True, capture_output=True, text=True
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['rows'] = rows
+    result['rows_per_sec'] = rows / result['seconds']
+    return result
+
+
+# Backend queries compared between storage backends
+STORAGE_QUERIES = {
+    'get_frequency_wide': lambda: backend.get_frequency_wide(),
+    'get_frequency_wide (melanoma)': lambda: backend.get_frequency_wide(condition='melanoma'),
+    'get_frequency_wide (prj1, t=0)': lambda: backend.get_frequency_wide(project='prj1', time_from_treatment_start=0),
+    'get_statistics': lambda: backend.get_statistics(),
+    'get_batch_statistics': lambda: backend.get_batch_statistics(),
+    'get_specific_subset_data': lambda: backend.get_specific_subset_data(),
+    'get_average_b_cell': lambda: backend.get_average_b_cell(),
+}
+
+
+def time_call(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_storage(rows, chunksize, workdir, repeat=3, **generator_options):
+    csv_path = synthetic_csv(workdir, rows, **generator_options)
+
+    backend.DB_name = os.path.splitext(csv_path)[0] + '.db'
+    backend.initialize_database()
+    backend.load_data(csv_path, chunksize=chunksize)
+
+    # Caching would turn every repeat into a hit
+    backend.configure_cache(max_bytes=0)
+
+    results = {}
+    for storage in backend.STORAGE_BACKENDS:
+        backend.set_storage_backend(storage, parquet_dir=os.path.splitext(csv_path)[0] + '.parquet')
+        results[storage] = {name: time_call(query, repeat) for name, query in STORAGE_QUERIES.items()}
+    backend.set_storage_backend('sqlite')
+    return results
+
+
+# Queries behind the dashboard's callbacks, hammered concurrently by the concurrency benchmark
+CONCURRENCY_QUERIES = {
+    'get_frequency_page': lambda: backend.get_frequency_page(page_current=5, page_size=20),
+    'get_frequency_page (sorted)': lambda: backend.get_frequency_page(sort_by=[('percentage', 'desc')]),
+    'get_specific_subset_page': lambda: backend.get_specific_subset_page(page_current=2, sex='F'),
+    'get_cohort_counts': lambda: backend.get_cohort_counts(('project',), **backend.BASELINE_FILTERS),
+    'get_average_b_cell': lambda: backend.get_average_b_cell(),
+}
+
+
+def run_threads(threads, calls_per_thread):
+    queries = list(CONCURRENCY_QUERIES.values())
+    latencies = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads)
+
+    def worker(i):
+        barrier.wait()
+        for call in range(calls_per_thread):
+            start = time.perf_counter()
+            queries[(i + call) % len(queries)]()
+            latencies[i].append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = np.concatenate(latencies) * 1000
+    return {
+        'threads': threads,
+        'calls': len(latencies),
+        'calls_per_sec': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+    }
+
+
+def benchmark_concurrency(rows, chunksize, workdir, threads=(1, 4, 16), calls_per_thread=50, **generator_options):
+    csv_path = synthetic_csv(workdir, rows, **generator_options)
+
+    backend.DB_name = os.path.splitext(csv_path)[0] + '.db'
+    backend.initialize_database()
+    backend.load_data(csv_path, chunksize=chunksize)
+
+    # Every call has to reach the database, otherwise this measures the result cache
+    backend.configure_cache(max_bytes=0)
+    return [run_threads(n, calls_per_thread) for n in threads]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_200(url, deadline, data=None):
+    while time.perf_counter() < deadline:
+        try:
+            request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(request, timeout=60) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except OSError:
+            time.sleep(0.02)
+    raise TimeoutError(f"No HTTP 200 from {url}")
+
+
+def benchmark_startup(rows, chunksize, workdir, timeout=300, **generator_options):
+    csv_path = synthetic_csv(workdir, rows, **generator_options)
+    db_path = os.path.splitext(csv_path)[0] + '.db'
+
+    # Loading is the separate one-time step, so it is not part of the startup time
+    backend.DB_name = db_path
+    backend.initialize_database()
+    backend.load_data(csv_path, chunksize=chunksize)
+
+    port = free_port()
+    env = dict(os.environ, CLINICAL_TRIAL_DB=db_path, RESULT_CACHE_DIR=os.path.splitext(csv_path)[0] + '.cache')
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-c', f"import app; app.server.run(port={port})"],
+        cwd=package_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        first_200 = wait_for_200(f'http://127.0.0.1:{port}/', start + timeout)
+
+        # First render of the statistics tab computes its data on demand
+        payload = json.dumps({
+            'output': 'tab-content.children',
+            'outputs': {'id': 'tab-content', 'property': 'children'},
+            'inputs': [{'id': 'tabs', 'property': 'value', 'value': 'statistics'}],
+            'changedPropIds': ['tabs.value'],
+            'state': [],
+        }).encode()
+        tab_start = time.perf_counter()
+        first_tab = wait_for_200(f'http://127.0.0.1:{port}/_dash-update-component', tab_start + timeout, data=payload)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {'rows': rows, 'first_200_seconds': first_200 - start, 'statistics_tab_seconds': first_tab - tab_start}
+
+
+# Benchmark suite: every backend entry point and the Dash callbacks on synthetic data, written to JSON
+# and compared against a stored baseline
+SUITE_ROWS = [10_000, 1_000_000, 10_000_000]
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+BACKEND_BENCHMARKS = {
+    'get_frequency_wide': lambda: backend.get_frequency_wide(),
+    'get_frequency': lambda: backend.get_frequency(),
+    'get_frequency_page': lambda: backend.get_frequency_page(page_current=5),
+    'get_frequency_page (sorted, filtered)': lambda: backend.get_frequency_page(
+        sort_by=[('percentage', 'desc')], conditions=[('population', 'eq', 'b_cell')]),
+    'iter_frequency_csv': lambda: sum(len(chunk) for chunk in backend.iter_frequency_csv()),
+    'get_statistics': lambda: backend.get_statistics(),
+    'get_batch_statistics': lambda: backend.get_batch_statistics(),
+    'get_batch_statistics (10k resamples, FDR)': lambda: backend.get_batch_statistics(resamples=10_000, correction='fdr'),
+    'get_batch_statistics (10k resamples, 2k bootstrap, FDR)': lambda: backend.get_batch_statistics(
+        resamples=10_000, bootstrap=2_000, correction='fdr'),
+    'get_box_summary': lambda: backend.get_box_summary(),
+    'get_trajectories': lambda: backend.get_trajectories(long=False),
+    'get_longitudinal_statistics': lambda: backend.get_longitudinal_statistics(),
+    'get_specific_subset_data': lambda: backend.get_specific_subset_data(),
+    'get_specific_subset_page': lambda: backend.get_specific_subset_page(page_current=2, sex='F'),
+    'get_cohort_counts': lambda: backend.get_cohort_counts(['project', 'sex', 'response'], **backend.BASELINE_FILTERS),
+    'get_average_b_cell': lambda: backend.get_average_b_cell(),
+    'find_full_scans': lambda: backend.find_full_scans(),
+}
+
+# Resampling costs grow with the number of resamples times the cohort size (minutes per call at 1M rows),
+# so these benchmarks only run on sizes up to the shipped export's
+BENCHMARK_MAX_ROWS = {
+    'get_batch_statistics (10k resamples, FDR)': 10_000,
+    'get_batch_statistics (10k resamples, 2k bootstrap, FDR)': 10_000,
+}
+
+# (outputs, inputs) of each callback request; the first input is the one that triggered it
+CALLBACK_BENCHMARKS = {
+    'render_tab (frequency)': ([('tab-content', 'children')], [('tabs', 'value', 'frequency')]),
+    'render_tab (statistics)': ([('tab-content', 'children')], [('tabs', 'value', 'statistics')]),
+    'render_tab (baseline)': ([('tab-content', 'children')], [('tabs', 'value', 'baseline')]),
+    'update_frequency_table': (
+        [('frequency-table', 'data'), ('frequency-table', 'page_count')],
+        [('frequency-table', 'page_current', 5), ('frequency-table', 'page_size', 20),
+         ('frequency-table', 'sort_by', [{'column_id': 'percentage', 'direction': 'desc'}]),
+         ('frequency-table', 'filter_query', '{population} eq "b_cell"')]
+    ),
+    'update_box_plot': (
+        [('box-plot', 'figure')],
+        [('population-dropdown', 'value', 'all'), ('box-points', 'value', ['points'])]
+    ),
+    'update_baseline_table': (
+        [('baseline-table', 'data'), ('baseline-table', 'page_count'), ('baseline-table', 'page_current'),
+         ('baseline-export', 'href'), ('metric-total', 'children'), ('metric-sex', 'children'),
+         ('metric-response', 'children')],
+        [('sex-filter', 'value', ['F']), ('project-filter', 'value', None), ('response-filter', 'value', None),
+         ('baseline-table', 'page_current', 0), ('baseline-table', 'page_size', 20)]
+    ),
+}
+
+
+def dash_payload(outputs, inputs):
+    # The request body the Dash renderer sends for a callback
+    if len(outputs) == 1:
+        output = f"{outputs[0][0]}.{outputs[0][1]}"
+        output_specs = {'id': outputs[0][0], 'property': outputs[0][1]}
+    else:
+        output = '..' + '...'.join(f"{id_}.{prop}" for id_, prop in outputs) + '..'
+        output_specs = [{'id': id_, 'property': prop} for id_, prop in outputs]
+    return json.dumps({
+        'output': output,
+        'outputs': output_specs,
+        'inputs': [{'id': id_, 'property': prop, 'value': value} for id_, prop, value in inputs],
+        'changedPropIds': [f"{inputs[0][0]}.{inputs[0][1]}"],
+        'state': [],
+    }).encode()
+
+
+def callback_benchmarks():
+    # Callbacks go through the Flask test client, so Dash's own request handling and JSON
+    # serialization are part of the measurement
+    import app
+
+    client = app.server.test_client()
+    benchmarks = {}
+    for name, (outputs, inputs) in CALLBACK_BENCHMARKS.items():
+        def call(payload=dash_payload(outputs, inputs), name=name):
+            app.build_box_figure.cache_clear()
+            response = client.post('/_dash-update-component', data=payload, content_type='application/json')
+            if response.status_code != 200:
+                raise RuntimeError(f"{name} returned HTTP {response.status_code}")
+        benchmarks[name] = call
+    return benchmarks
+
+
+def time_repeated(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'min_seconds': min(times), 'median_seconds': float(np.median(times)), 'repeat': repeat}
+
+
+def run_suite(rows_list, chunksize, workdir, repeat=3, **generator_options):
+    options = {key: value for key, value in generator_options.items() if value is not None}
+    results = {}
+    for rows in rows_list:
+        csv_path = synthetic_csv(workdir, rows, **options)
+        backend.DB_name = os.path.splitext(csv_path)[0] + '.db'
+
+        # A fresh database every time, so the load is measured from scratch
+        start = time.perf_counter()
+        backend.initialize_database(reset=True)
+        backend.load_data(csv_path, incremental=False, chunksize=chunksize)
+        load_seconds = time.perf_counter() - start
+        size_results = {'load_data': {'min_seconds': load_seconds, 'median_seconds': load_seconds, 'repeat': 1,
+                                      'rows_per_sec': rows / load_seconds}}
+
+        # Importing app configures the cache, so it is disabled afterwards: every call has to do
+        # its work, otherwise the repeats only measure the result cache
+        benchmarks = dict(BACKEND_BENCHMARKS, **callback_benchmarks())
+        backend.configure_cache(max_bytes=0)
+        for name, func in benchmarks.items():
+            if rows > BENCHMARK_MAX_ROWS.get(name, rows):
+                continue
+            print(f"{rows:>12,} rows  {name}")
+            size_results[name] = time_repeated(func, repeat)
+        results[str(rows)] = size_results
+
+    return {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': sys.platform,
+            'cpu_count': os.cpu_count(),
+            'chunksize': chunksize,
+            'generator': {key: value for key, value in options.items()},
+        },
+        'results': results,
+    }
+
+
+def find_regressions(results, baseline, tolerance=0.25, min_delta=0.005):
+    # A benchmark regresses when its best time is more than `tolerance` slower than the baseline's
+    # and by more than min_delta seconds, which keeps timer noise on the fastest calls out
+    regressions = []
+    for rows, benchmarks in results['results'].items():
+        for name, result in benchmarks.items():
+            previous = baseline.get('results', {}).get(rows, {}).get(name)
+            if previous is None:
+                continue
+            current, before = result['min_seconds'], previous['min_seconds']
+            if current > before * (1 + tolerance) and current - before > min_delta:
+                regressions.append({'rows': int(rows), 'benchmark': name, 'baseline_seconds': before,
+                                    'seconds': current, 'slowdown': current / before})
+    return regressions
+
+
+def find_unbaselined(results, baseline):
+    # Benchmarks without a baseline entry can never be flagged, so they are reported until the baseline is updated
+    return [(int(rows), name) for rows, benchmarks in results['results'].items() for name in benchmarks
+            if name not in baseline.get('results', {}).get(rows, {})]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'load-worker':
+        run_load(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Benchmark the data layer on synthetic cell-count exports.")
+    parser.add_argument('benchmark', nargs='?', choices=['load', 'storage', 'startup', 'concurrency', 'suite'], default='load',
+                        help="'load' measures CSV ingest, 'storage' compares SQLite and Parquet on each backend query, "
+                             "'startup' measures dashboard time to first HTTP 200, "
+                             "'concurrency' reports query latency under N threads, "
+                             "'suite' times every backend function and Dash callback and checks them against a baseline")
+    parser.add_argument('--rows', type=int, nargs='+', default=None)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--chunksize', type=int, default=backend.CHUNK_SIZE)
+    parser.add_argument('--workdir', default=None, help="Directory for generated CSVs and databases (default: temporary)")
+    parser.add_argument('--projects', type=int, default=None, help="Synthetic data: number of projects (default 3)")
+    parser.add_argument('--subjects', type=int, default=None,
+                        help="Synthetic data: number of subjects the rows are spread over (default rows / samples per "
+                             "subject). Without --rows, the size is subjects x samples per subject")
+    parser.add_argument('--samples-per-subject', type=int, default=None,
+                        help="Synthetic data: samples per subject (default one per timepoint)")
+    parser.add_argument('--timepoints', type=int, nargs='+', default=None,
+                        help=f"Synthetic data: time_from_treatment_start values (default {TIMEPOINTS})")
+    parser.add_argument('--seed', type=int, default=None, help="Synthetic data: random seed (default 0)")
+    parser.add_argument('--repeat', type=int, default=3, help="Suite: runs per benchmark")
+    parser.add_argument('--output', default='benchmark_results.json', help="Suite: where to write the results")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="Suite: results to check for regressions against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Suite: allowed slowdown before flagging, 0.25 = 25%%")
+    parser.add_argument('--update-baseline', action='store_true', help="Suite: save the results as the new baseline")
+    args = parser.parse_args()
+
+    generator = {'projects': args.projects, 'subjects': args.subjects, 'samples_per_subject': args.samples_per_subject,
+                 'timepoints': args.timepoints, 'seed': args.seed}
+    if args.rows is None and args.subjects is not None:
+        args.rows = [args.subjects * (args.samples_per_subject or len(args.timepoints or TIMEPOINTS))]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        if args.benchmark == 'load':
+            for rows in args.rows or DEFAULT_ROWS:
+                result = benchmark_load(rows, args.chunksize, workdir, **generator)
+                print(f"{rows:>12,} rows  {result['rows_per_sec']:>12,.0f} rows/sec  peak RSS {result['peak_rss_mb']:,.1f} MB")
+        elif args.benchmark == 'startup':
+            for rows in args.rows or [1_000_000]:
+                result = benchmark_startup(rows, args.chunksize, workdir, **generator)
+                print(f"{rows:>12,} rows  first HTTP 200 after {result['first_200_seconds']:.2f}s  "
+                      f"statistics tab {result['statistics_tab_seconds']:.2f}s")
+        elif args.benchmark == 'suite':
+            results = run_suite(args.rows or SUITE_ROWS, args.chunksize, workdir, args.repeat, **generator)
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {args.output}")
+
+            if args.update_baseline:
+                with open(args.baseline, 'w') as f:
+                    json.dump(results, f, indent=2)
+                print(f"Baseline updated: {args.baseline}")
+            elif os.path.exists(args.baseline):
+                with open(args.baseline) as f:
+                    baseline = json.load(f)
+                for rows, name in find_unbaselined(results, baseline):
+                    print(f"NO BASELINE {rows:>12,} rows  {name}")
+                regressions = find_regressions(results, baseline, args.tolerance)
+                for r in regressions:
+                    print(f"REGRESSION {r['rows']:>12,} rows  {r['benchmark']:<40}"
+                          f"{r['baseline_seconds']:.3f}s -> {r['seconds']:.3f}s ({r['slowdown']:.2f}x)")
+                if regressions:
+                    sys.exit(1)
+                print("No regressions against the baseline")
+        elif args.benchmark == 'concurrency':
+            for rows in args.rows or [1_000_000]:
+                print(f"\n{rows:,} rows")
+                print(f"{'threads':>8}{'calls/sec':>12}{'p50 (ms)':>11}{'p99 (ms)':>11}")
+                for result in benchmark_concurrency(rows, args.chunksize, workdir, args.threads, **generator):
+                    print(f"{result['threads']:>8}{result['calls_per_sec']:>12,.1f}{result['p50_ms']:>11.2f}{result['p99_ms']:>11.2f}")
+        else:
+            for rows in args.rows or [1_000_000]:
+                results = benchmark_storage(rows, args.chunksize, workdir, **generator)
+                print(f"\n{rows:,} rows")
+                print(f"{'query':<34}{'sqlite (s)':>12}{'parquet (s)':>13}{'speedup':>9}")
+                for name in STORAGE_QUERIES:
+                    sqlite_time, parquet_time = results['sqlite'][name], results['parquet'][name]
+                    print(f"{name:<34}{sqlite_time:>12.3f}{parquet_time:>13.3f}{sqlite_time / parquet_time:>8.1f}x")
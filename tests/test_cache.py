@@ -0,0 +1,82 @@
+import os
+
+import pandas as pd
+import pytest
+
+import backend
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cell-count.csv')
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    # A fresh database and result cache with an on-disk tier, both under tmp_path
+    monkeypatch.setattr(backend, 'DB_name', str(tmp_path / 'clinical_trial.db'))
+    monkeypatch.setattr(backend, 'result_cache', backend.ResultCache(disk_dir=str(tmp_path / 'cache')))
+    backend.initialize_database()
+    backend.load_data(CSV_PATH)
+    return tmp_path
+
+
+def _restart(tmp_path, monkeypatch):
+    # What a new process sees: an empty memory tier and new connections over the same files
+    monkeypatch.setattr(backend, 'result_cache', backend.ResultCache(disk_dir=str(tmp_path / 'cache')))
+    monkeypatch.setattr(backend, '_read_pool', None)
+    monkeypatch.setattr(backend, '_writer', None)
+
+
+def test_disk_tier_survives_restart(database, monkeypatch):
+    average = backend.get_average_b_cell()
+    _restart(database, monkeypatch)
+    assert backend.get_average_b_cell() == average
+    assert backend.result_cache.hits == 1
+
+
+def test_recreated_database_is_not_served_old_results(database, monkeypatch):
+    average = backend.get_average_b_cell()
+    version = backend.get_data_version()
+
+    doubled = pd.read_csv(CSV_PATH)
+    doubled['b_cell'] *= 2
+    doubled.to_csv(database / 'doubled.csv', index=False)
+
+    _restart(database, monkeypatch)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(backend.DB_name + suffix):
+            os.remove(backend.DB_name + suffix)
+    backend.initialize_database()
+    backend.load_data(str(database / 'doubled.csv'))
+
+    # Same path and user_version as before, but a different database
+    assert backend.get_data_version().split('.')[1] == version.split('.')[1]
+    assert backend.get_data_version() != version
+    assert backend.get_average_b_cell() == pytest.approx(2 * average)
+
+
+def test_reset_invalidates_cached_results(database):
+    backend.get_average_b_cell()
+    version = backend.get_data_version()
+    backend.initialize_database(reset=True)
+    assert backend.get_data_version() != version
+    assert pd.isna(backend.get_average_b_cell())
+
+
+def test_disk_tier_is_trimmed(tmp_path):
+    cache = backend.ResultCache(disk_dir=str(tmp_path))
+    frame = pd.DataFrame({'count': range(1000)})
+    cache.put(('v1', 'a'), frame)
+    cache.disk_max_bytes = 2 * cache._disk_files()[0][1]
+    cache.put(('v1', 'b'), frame)
+    cache.put(('v1', 'c'), frame)
+    files = cache._disk_files()
+    assert len(files) == 2
+    assert sum(size for _, size, _, _ in files) <= cache.disk_max_bytes
+
+
+def test_disk_tier_is_pruned_on_a_new_version(tmp_path):
+    cache = backend.ResultCache(disk_dir=str(tmp_path))
+    cache.put(('a.1', 'x'), 1)
+    cache.put(('a.2', 'x'), 2)
+    cache.check_version('a.2')
+    assert [name.split('-')[0] for _, _, name, _ in cache._disk_files()] == ['a.2']
+    assert cache.get(('a.1', 'x')) == (False, None)
@@ -0,0 +1,52 @@
+import os
+
+import pandas as pd
+import pytest
+
+import backend
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cell-count.csv')
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend, 'DB_name', str(tmp_path / 'clinical_trial.db'))
+    monkeypatch.setattr(backend, 'result_cache', backend.ResultCache(max_bytes=0))
+    backend.initialize_database()
+    backend.load_data(CSV_PATH)
+    return tmp_path
+
+
+def _summary():
+    with backend.read_connection() as con:
+        return set(con.execute("SELECT * FROM cohort_summary WHERE sample_count > 0"))
+
+
+def _rebuilt_summary():
+    with backend.write_connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        backend.rebuild_cohort_summary(con)
+        con.execute("COMMIT")
+    return _summary()
+
+
+def test_summary_matches_samples_after_load(database):
+    assert _summary() == _rebuilt_summary()
+
+
+def test_triggers_follow_updates_and_deletes(database):
+    # A subject changes response, a sample moves subject and another moves timepoint, and a sample is added
+    changed = pd.read_csv(CSV_PATH)
+    subjects = changed['subject'].unique()
+    changed.loc[changed['subject'] == subjects[0], 'response'] = 'yes'
+    changed.loc[0, 'subject'] = subjects[-1]
+    changed.loc[1, 'time_from_treatment_start'] = 14
+    changed = pd.concat([changed, changed.iloc[[2]].assign(sample='sample_new')])
+    changed.to_csv(database / 'changed.csv', index=False)
+    backend.load_data(str(database / 'changed.csv'))
+
+    with backend.write_connection() as con:
+        con.execute("DELETE FROM samples WHERE sample = 'sample00003'")
+
+    assert _summary() == _rebuilt_summary()
+    assert backend.get_cohort_counts()['sample_count'][0] == len(changed) - 1
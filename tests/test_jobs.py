@@ -0,0 +1,68 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+import backend
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cell-count.csv')
+
+
+@pytest.fixture
+def jobs(tmp_path, monkeypatch):
+    # A fresh database and job table under tmp_path. Workers are spawned, so they read JOBS_DB and
+    # JOBS_DIR from the environment
+    monkeypatch.setattr(backend, 'DB_name', str(tmp_path / 'clinical_trial.db'))
+    monkeypatch.setattr(backend, 'result_cache', backend.ResultCache(max_bytes=0))
+    for name in ('JOBS_DB', 'JOBS_DIR'):
+        path = str(tmp_path / name.lower())
+        monkeypatch.setenv(name, path)
+        monkeypatch.setattr(backend, name, path)
+    monkeypatch.setattr(backend, 'JOB_WORKERS', 1)
+    monkeypatch.setattr(backend, '_job_executor', None)
+    backend.initialize_database()
+    backend.load_data(CSV_PATH)
+    yield tmp_path
+    if backend._job_executor is not None:
+        backend._job_executor.shutdown()
+
+
+def _wait(job_id, timeout=60):
+    end = time.time() + timeout
+    while time.time() < end:
+        job = backend.get_job(job_id)
+        if job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.1)
+    raise TimeoutError(job_id)
+
+
+def test_identical_jobs_share_one_result(jobs):
+    job_id = backend.submit_job('baseline_csv', condition='melanoma')
+    assert backend.submit_job('baseline_csv', condition='melanoma') == job_id
+    assert _wait(job_id)['status'] == 'done'
+    expected = backend.get_specific_subset_data(condition='melanoma')
+    assert len(pd.read_csv(backend.job_result(job_id))) == len(expected)
+
+
+def test_recreated_database_runs_jobs_again(jobs, monkeypatch):
+    job_id = backend.submit_job('baseline_csv')
+    assert _wait(job_id)['status'] == 'done'
+    result_path = backend.get_job(job_id)['result_path']
+    version = backend.get_data_version()
+
+    monkeypatch.setattr(backend, '_read_pool', None)
+    monkeypatch.setattr(backend, '_writer', None)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(backend.DB_name + suffix):
+            os.remove(backend.DB_name + suffix)
+    backend.initialize_database()
+    backend.load_data(CSV_PATH)
+    assert backend.get_data_version().split('.')[1] == version.split('.')[1]
+
+    # Same path and user_version, but a different database: the old result is neither reused nor kept
+    assert backend.submit_job('baseline_csv') != job_id
+    assert backend.prune_jobs() == 1
+    assert backend.get_job(job_id) is None
+    assert not os.path.exists(result_path)
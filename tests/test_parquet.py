@@ -0,0 +1,65 @@
+import os
+
+import pandas as pd
+import pytest
+
+import backend
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cell-count.csv')
+
+
+@pytest.fixture
+def parquet_database(tmp_path, monkeypatch):
+    # A fresh database served from a Parquet dataset under tmp_path, with the result cache disabled
+    monkeypatch.setattr(backend, 'DB_name', str(tmp_path / 'clinical_trial.db'))
+    monkeypatch.setattr(backend, 'result_cache', backend.ResultCache(max_bytes=0))
+    monkeypatch.setattr(backend, 'storage_backend', backend.storage_backend)
+    monkeypatch.setattr(backend, 'PARQUET_DIR', backend.PARQUET_DIR)
+    backend.initialize_database()
+    backend.load_data(CSV_PATH)
+    backend.set_storage_backend('parquet', parquet_dir=str(tmp_path / 'samples_parquet'))
+    return tmp_path
+
+
+def test_recreated_database_is_exported_again(parquet_database, monkeypatch):
+    average = backend.get_average_b_cell()
+    version = backend.get_data_version()
+
+    doubled = pd.read_csv(CSV_PATH)
+    doubled['b_cell'] *= 2
+    doubled.to_csv(parquet_database / 'doubled.csv', index=False)
+
+    monkeypatch.setattr(backend, '_read_pool', None)
+    monkeypatch.setattr(backend, '_writer', None)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(backend.DB_name + suffix):
+            os.remove(backend.DB_name + suffix)
+    # Loaded as if by another process, so the export is left at the old database's version
+    monkeypatch.setattr(backend, 'storage_backend', 'sqlite')
+    backend.initialize_database()
+    backend.load_data(str(parquet_database / 'doubled.csv'))
+    monkeypatch.setattr(backend, 'storage_backend', 'parquet')
+
+    assert backend.get_data_version().split('.')[1] == version.split('.')[1]
+    assert backend.get_average_b_cell() == pytest.approx(2 * average)
+
+
+def test_replaced_export_stays_readable(parquet_database, monkeypatch):
+    old = backend._parquet_dataset()
+
+    changed = pd.read_csv(CSV_PATH)
+    changed['b_cell'] += 1
+    changed.to_csv(parquet_database / 'changed.csv', index=False)
+    monkeypatch.setattr(backend, 'storage_backend', 'sqlite')
+    backend.load_data(str(parquet_database / 'changed.csv'))
+    monkeypatch.setattr(backend, 'storage_backend', 'parquet')
+
+    # A reader that opened the old export before the switch can still read it
+    new = backend._parquet_dataset()
+    assert old.to_table().num_rows == new.to_table().num_rows
+    assert len(os.listdir(backend.PARQUET_DIR)) == 3
+
+    # Once the grace period has passed, only the pointer and the live export are left
+    monkeypatch.setattr(backend, 'PARQUET_KEEP_SECONDS', -1)
+    backend._remove_old_parquet()
+    assert sorted(os.listdir(backend.PARQUET_DIR)) == ['CURRENT', backend._parquet_current()]
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+import backend
+
+CSV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cell-count.csv')
+
+
+@pytest.fixture(scope='module')
+def loaded_database(tmp_path_factory):
+    # A fresh database loaded from the shipped CSV, so ANALYZE has run and the planner sees real statistics
+    db_name = backend.DB_name
+    backend.DB_name = str(tmp_path_factory.mktemp('db') / 'clinical_trial.db')
+    try:
+        backend.initialize_database()
+        backend.load_data(CSV_PATH)
+        yield backend.DB_name
+    finally:
+        backend.DB_name = db_name
+
+
+def test_backend_queries_use_indexes(loaded_database):
+    assert backend.find_full_scans() == {}
+
+
+def test_full_scans_are_reported(loaded_database):
+    queries = {
+        'unindexed filter': ("SELECT sample FROM samples WHERE b_cell > ?", (0,)),
+        'index scan': ("SELECT subject_id, time_from_treatment_start FROM samples", ()),
+    }
+    assert set(backend.find_full_scans(queries)) == {'unindexed filter', 'index scan'}